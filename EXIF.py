@@ -29,6 +29,22 @@
 #
 # Otherwise these tags will be ignored
 #
+# Thumbnails are only extracted when asked for, with
+#    tags = EXIF.process_file(f, thumbnail=True)
+# or located without reading them with thumbnail='offset'.
+#
+# Files that cannot seek, like pipes, sockets and tarfile or zipfile
+# members, are read forward keeping up to 1 MB in memory, e.g.
+#    tags = EXIF.process_file(tar.extractfile(member))
+# Files with EXIF data further in warn and return the tags found; use
+# ParseContext(stream_buffer=...) to allow more.
+#
+# process_file keeps no state between calls, so files can be parsed from
+# several threads at once. To parse many files on several threads or
+# processes, call
+#    for result in EXIF.process_files(paths, workers=8, backend='process'):
+#        print result.path, result.error or result.tags
+#
 # Returned tags will be a dictionary mapping names of EXIF tags to their
 # values in the file named by path_name.  You can process the tags
 # as you wish.  In particular, you can iterate through all the tags with:
@@ -83,6 +99,22 @@
 #
 
 
+import os
+import sys
+import errno
+import mmap
+import stat
+import time
+import array
+import struct
+import warnings
+import datetime
+import itertools
+import json
+import collections
+import multiprocessing
+import multiprocessing.pool
+
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
     str = ''
@@ -1185,19 +1217,45 @@ def s2n_intel(str):
         y = y + 8
     return x
 
+# precompiled structs to decode integers from a buffer, indexed by
+# (endian, length, signed)
+S2N_STRUCTS = {}
+for _endian, _prefix in (('I', '<'), ('M', '>')):
+    for _length, _code in ((1, 'b'), (2, 'h'), (4, 'l'), (8, 'q')):
+        S2N_STRUCTS[(_endian, _length, 1)] = struct.Struct(_prefix + _code)
+        S2N_STRUCTS[(_endian, _length, 0)] = struct.Struct(_prefix + _code.upper())
+
+# array typecodes holding the values of each numeric field type (rationals
+# are held as pairs of numerator and denominator)
+ARRAY_TYPECODES = {}
+for _field_type, _size, _codes in ((1, 1, 'B'), (3, 2, 'H'), (4, 4, 'IL'), (5, 4, 'IL'),
+                                   (6, 1, 'b'), (7, 1, 'B'), (8, 2, 'h'), (9, 4, 'il'),
+                                   (10, 4, 'il')):
+    for _code in _codes:
+        if array.array(_code).itemsize == _size:
+            ARRAY_TYPECODES[_field_type] = _code
+            break
+
 # ratio object that eventually will be able to reduce itself to lowest
 # common denominator for printing
 def gcd(a, b):
-    if b == 0:
-        return a
-    else:
-        return gcd(b, a % b)
+    while b != 0:
+        a, b = b, a % b
+    return a
+
+class Ratio(object):
+    __slots__ = ('num', 'den')
 
-class Ratio:
     def __init__(self, num, den):
         self.num = num
         self.den = den
 
+    def __getstate__(self):
+        return self.num, self.den
+
+    def __setstate__(self, state):
+        self.num, self.den = state
+
     def __repr__(self):
         self.reduce()
         if self.den == 1:
@@ -1210,12 +1268,49 @@ class Ratio:
             self.num = self.num / div
             self.den = self.den / div
 
+# values as a list of the ints and longs s2n returns, for printing
+def values_list(values, endian):
+    if not isinstance(values, array.array):
+        return values
+    if endian == 'I':
+        return map(long, values)
+    if values.typecode in 'bhil' and values and min(values) < 0:
+        return [value if value >= 0 else long(value) for value in values]
+    return map(int, values)
+
+# printable version of the values of a tag, using the optional 2nd element
+# of its tag_entry to name them
+def format_values(values, count, field_type, tag_entry, endian):
+    listed = values_list(values, endian)
+    if tag_entry and len(tag_entry) != 1:
+        if callable(tag_entry[1]):
+            # call mapping function
+            return tag_entry[1](listed)
+        # use lookup table for this tag
+        return ''.join([tag_entry[1].get(i, repr(i)) for i in listed])
+    if count == 1 and field_type != 2:
+        return str(values[0])
+    elif count > 50 and len(values) > 20:
+        return str(listed[0:20])[0:-1] + ", ... ]"
+    return str(listed)
+
 # for ease of dealing with tags
-class IFD_Tag:
+#
+# The printable version is computed when it is first used, from the values,
+# count, tag_entry and endian given instead of printable. Numeric values
+# decoded in bulk are kept in an array, and values turns them into the list
+# of ints and longs of older versions when it is first used.
+class IFD_Tag(object):
+    __slots__ = ('_printable', '_format', 'tag', 'field_type', 'field_offset',
+                 'field_length', '_values', '_endian')
+
     def __init__(self, printable, tag, field_type, values, field_offset,
-                 field_length):
+                 field_length, count=None, tag_entry=None, endian=None):
         # printable version of data
-        self.printable = printable
+        self._printable = printable
+        self._format = None
+        if printable is None:
+            self._format = (count, tag_entry, endian)
         # tag ID number
         self.tag = tag
         # field type as index into FIELD_TYPES
@@ -1224,8 +1319,42 @@ class IFD_Tag:
         self.field_offset = field_offset
         # length of data field in bytes
         self.field_length = field_length
-        # either a string or array of data items
-        self.values = values
+        # either a string or list of data items
+        self._values = values
+        self._endian = endian
+
+    def _get_values(self):
+        if isinstance(self._values, array.array):
+            self._values = values_list(self._values, self._endian)
+        return self._values
+
+    def _set_values(self, values):
+        self._values = values
+
+    values = property(_get_values, _set_values)
+
+    def _get_printable(self):
+        if self._format is not None:
+            count, tag_entry, endian = self._format
+            self._printable = format_values(self._values, count, self.field_type, tag_entry, endian)
+            self._format = None
+        return self._printable
+
+    def _set_printable(self, printable):
+        self._printable = printable
+        self._format = None
+
+    printable = property(_get_printable, _set_printable)
+
+    # tags are pickled formatted, as the formatter may be a lambda
+    def __getstate__(self):
+        return (self.printable, self.tag, self.field_type, self.field_offset,
+                self.field_length, self._values, self._endian)
+
+    def __setstate__(self, state):
+        (self._printable, self.tag, self.field_type, self.field_offset,
+         self.field_length, self._values, self._endian) = state
+        self._format = None
 
     def __str__(self):
         return self.printable
@@ -1236,22 +1365,206 @@ class IFD_Tag:
                                         self.printable,
                                         self.field_offset)
 
+# settings of process_file calls. A context only holds settings, and what
+# is found while parsing a file is kept in the EXIF_header and a
+# ParseReport, so one context can be shared by threads parsing files at
+# once.
+#
+# bulk_values decodes IFD entries and value arrays in bulk with struct and
+# array; turning it off decodes them value by value as older versions did.
+#
+# The work done on one file is limited to max_ifds IFDs, max_entries IFD
+# entries, max_bytes bytes of tag values and thumbnails and max_time
+# seconds (None for no limit). A file going over a limit, or with an IFD
+# chain that loops, is parsed no further and the tags found so far are
+# returned; the problem is added to the warnings of the ParseReport as a
+# ParseWarning and reported with warnings.warn as an ExifWarning. In strict
+# mode an ExifLimitError is raised instead.
+#
+# Streams that cannot seek are parsed from a buffer of the first
+# stream_buffer bytes of the stream; files needing data beyond it are
+# handled like files going over a limit.
+class ParseContext:
+    def __init__(self, details=True, strict=False, stop_tag='UNDEF', debug=False,
+                 bulk_values=True, max_ifds=64, max_entries=16384, max_bytes=2**26,
+                 max_time=10.0, thumbnail=False, stream_buffer=2**20):
+        self.details = details
+        self.stream_buffer = stream_buffer
+        self.thumbnail = thumbnail
+        self.strict = strict
+        self.stop_tag = stop_tag
+        self.debug = debug
+        self.bulk_values = bulk_values
+        self.max_ifds = max_ifds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+
+# what parsing one file found besides its tags: the ParseWarnings, for a
+# JPEG file its JpegSegments, and for a memory mapped file the number of
+# bytes used from the mapping. Give one to process_file to get them.
+class ParseReport:
+    def __init__(self):
+        self.warnings = []
+        self.segments = []
+        self.bytes_mapped = 0
+
+    def warn(self, reason, message):
+        self.warnings.append(ParseWarning(reason, message))
+        warnings.warn(message, ExifWarning, stacklevel=3)
+
+# position of a thumbnail in the file: offset from the start of the file
+# and length in bytes
+ThumbnailRef = collections.namedtuple('ThumbnailRef', 'offset length')
+
+# a problem found while parsing a file: the reason ('ifd_cycle', 'max_ifds',
+# 'max_entries', 'max_bytes', 'max_time' or 'stream_buffer') and a message
+ParseWarning = collections.namedtuple('ParseWarning', 'reason message')
+
+class ExifWarning(UserWarning):
+    pass
+
+class ExifLimitError(ValueError):
+    def __init__(self, reason, message):
+        ValueError.__init__(self, message)
+        self.reason = reason
+        # the tags found before the limit was reached
+        self.tags = {}
+
+# read-only file object over a stream that cannot seek (a pipe, socket or
+# archive member), keeping the first limit bytes read from it so they can
+# be read again after seeking back. Reading data beyond them raises an
+# ExifLimitError.
+class StreamFile(object):
+    def __init__(self, f, limit):
+        self.f = f
+        self.limit = limit
+        self.data = bytearray()
+        self.pos = 0
+        self.eof = False
+
+    # read the stream up to offset end, or to its end
+    def fill(self, end):
+        while len(self.data) < min(end, self.limit) and not self.eof:
+            chunk = self.f.read(min(max(end, len(self.data) + 2**16), self.limit) - len(self.data))
+            if chunk:
+                self.data.extend(chunk)
+            else:
+                self.eof = True
+        if end > self.limit and not self.eof:
+            # the data may still end right at the limit
+            if self.f.read(1):
+                raise ExifLimitError('stream_buffer', 'data at offset %d of the stream is beyond '
+                                     'the %d byte stream buffer' % (min(end, self.pos + 1), self.limit))
+            self.eof = True
+
+    def read(self, size=-1):
+        if size < 0:
+            self.fill(self.limit + 1)
+            end = len(self.data)
+        else:
+            end = self.pos + size
+            self.fill(end)
+        data = str(self.data[self.pos:end])
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            self.fill(self.limit + 1)
+            offset += len(self.data)
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+# whether f can seek, so it does not need a StreamFile. Wrappers such as
+# tarfile members and gzip files can seek if the file they read from can.
+def seekable(f):
+    if hasattr(f, 'seekable'):
+        return f.seekable()
+    if hasattr(f, 'fileobj'):
+        return seekable(f.fileobj)
+    if not hasattr(f, 'seek'):
+        return False
+    try:
+        f.tell()
+        return True
+    except Exception:
+        return False
+
 # class that handles an EXIF header
+#
+# If data is given, it holds the bytes of the file starting at data_offset
+# (usually the whole APP1 segment or the start of a TIFF file), and values
+# inside it are decoded from memory instead of seeking and reading the file.
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    def __init__(self, file, endian, offset, fake_exif, context,
+                 data=None, data_offset=0, report=None, mapped=False):
         self.file = file
         self.endian = endian
         self.offset = offset
         self.fake_exif = fake_exif
-        self.strict = strict
-        self.debug = debug
+        self.context = context
+        self.report = report or ParseReport()
+        self.strict = context.strict
+        self.debug = context.debug
+        self.detailed = context.details
+        self.bulk_values = context.bulk_values
+        self.data = data
+        self.data_offset = data_offset
+        # whether data is a memory mapped file, whose use is reported
+        self.mapped = mapped
         self.tags = {}
+        # work done so far, checked against the limits of the context
+        self.ifds = 0
+        self.entries = 0
+        self.bytes = 0
+        self.start_time = time.time()
+
+    # stop parsing if doing the given work goes over a limit
+    def check_limit(self, reason, used, limit):
+        if limit is not None and used > limit:
+            raise ExifLimitError(reason, '%s over %s (%s)' % (reason, limit, used))
+        self.check_time()
+
+    def check_time(self):
+        if self.context.max_time is not None and time.time() - self.start_time > self.context.max_time:
+            raise ExifLimitError('max_time', 'max_time over %s seconds' % self.context.max_time)
+
+    def use_bytes(self, length):
+        self.bytes += length
+        self.check_limit('max_bytes', self.bytes, self.context.max_bytes)
+
+    # read length bytes at offset (relative to self.offset)
+    def read(self, offset, length):
+        if self.data is not None:
+            pos = self.offset + offset - self.data_offset
+            if pos >= 0 and pos + length <= len(self.data):
+                if self.mapped:
+                    self.report.bytes_mapped += length
+                return self.data[pos:pos + length]
+        self.file.seek(self.offset + offset)
+        return self.file.read(length)
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
+        fmt = S2N_STRUCTS.get((self.endian, length, signed))
+        if self.data is not None and fmt is not None:
+            pos = self.offset + offset - self.data_offset
+            if pos >= 0 and pos + length <= len(self.data):
+                if self.mapped:
+                    self.report.bytes_mapped += length
+                val = fmt.unpack_from(self.data, pos)[0]
+                # s2n_intel and the sign extension below return longs
+                if self.endian == 'I' or val < 0:
+                    val = long(val)
+                return val
         self.file.seek(self.offset+offset)
         slice=self.file.read(length)
         if self.endian == 'I':
@@ -1265,6 +1578,37 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # decode the table of 12 byte entries of an IFD in one go into a list
+    # of (tag, field type, count, value or offset) tuples, or return None
+    # if the table cannot be read.
+    def s2n_entries(self, offset, entries):
+        if self.endian not in ('I', 'M'):
+            return None
+        data = self.read(offset, entries * 12)
+        if len(data) != entries * 12:
+            return None
+        fields = struct.unpack((self.endian == 'I' and '<' or '>') + 'HHLL' * entries, data)
+        return [fields[i:i + 4] for i in range(0, len(fields), 4)]
+
+    # decode count values of a numeric field type in one go, into an array
+    # (or a list of Ratios), or return None if they cannot be read.
+    def s2n_values(self, offset, field_type, count):
+        code = ARRAY_TYPECODES.get(field_type)
+        if code is None or self.endian not in ('I', 'M'):
+            return None
+        length = count * FIELD_TYPES[field_type][0]
+        data = self.read(offset, length)
+        if len(data) != length:
+            return None
+        values = array.array(code)
+        values.fromstring(data)
+        if (self.endian == 'I') != (sys.byteorder == 'little'):
+            values.byteswap()
+        if field_type in (5, 10):
+            pairs = iter(values)
+            return [Ratio(num, den) for num, den in itertools.izip(pairs, pairs)]
+        return values
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1285,22 +1629,49 @@ class EXIF_header:
         entries=self.s2n(ifd, 2)
         return self.s2n(ifd+2+12*entries, 4)
 
+    # return pointer to next IFD, or 0 if the chain loops back
+    def next_IFD_checked(self, ifd, seen):
+        i = self.next_IFD(ifd)
+        if i in seen:
+            if self.strict:
+                raise ExifLimitError('ifd_cycle', 'IFD chain loops back to offset %d' % i)
+            self.report.warn('ifd_cycle', 'IFD chain loops back to offset %d' % i)
+            return 0
+        seen.add(i)
+        return i
+
     # return list of IFDs in header
     def list_IFDs(self):
         i=self.first_IFD()
         a=[]
+        seen=set([i])
         while i:
             a.append(i)
-            i=self.next_IFD(i)
+            self.check_limit('max_ifds', len(a), self.context.max_ifds)
+            i=self.next_IFD_checked(i, seen)
         return a
 
     # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
+    # If wanted is given, only the tags in it are decoded, and the IFD is
+    # left as soon as all the tags in remaining (a set that is updated) have
+    # been found.
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF',
+                 wanted=None, remaining=None):
         entries=self.s2n(ifd, 2)
+        self.ifds += 1
+        self.check_limit('max_ifds', self.ifds, self.context.max_ifds)
+        self.entries += entries
+        self.check_limit('max_entries', self.entries, self.context.max_entries)
+        table = None
+        if self.bulk_values:
+            table = self.s2n_entries(ifd + 2, entries)
         for i in range(entries):
             # entry is index of start of this IFD in the file
             entry = ifd + 2 + 12 * i
-            tag = self.s2n(entry, 2)
+            if table:
+                tag, field_type, count, pointer = table[i]
+            else:
+                tag = self.s2n(entry, 2)
 
             # get tag name early to avoid errors, help debug
             tag_entry = dict.get(tag)
@@ -1309,9 +1680,16 @@ class EXIF_header:
             else:
                 tag_name = 'Tag 0x%04X' % tag
 
+            # skip tags that are not projected
+            if wanted is not None and ifd_name + ' ' + tag_name not in wanted:
+                if tag_name == stop_tag:
+                    break
+                continue
+
             # ignore certain tags for faster processing
-            if not (not detailed and tag in IGNORE_TAGS):
-                field_type = self.s2n(entry + 2, 2)
+            if not (not self.detailed and tag in IGNORE_TAGS):
+                if not table:
+                    field_type = self.s2n(entry + 2, 2)
                 
                 # unknown field type
                 if not 0 < field_type < len(FIELD_TYPES):
@@ -1321,7 +1699,9 @@ class EXIF_header:
                         raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
 
                 typelen = FIELD_TYPES[field_type][0]
-                count = self.s2n(entry + 4, 4)
+                if not table:
+                    count = self.s2n(entry + 4, 4)
+                    pointer = None
                 # Adjust for tag id/type/count (2+2+4 bytes)
                 # Now we point at either the data or the 2nd level offset
                 offset = entry + 8
@@ -1335,13 +1715,14 @@ class EXIF_header:
                     # is for the Nikon type 3 makernote.  Other cameras may use
                     # other relative offsets, which would have to be computed here
                     # slightly differently.
+                    if pointer is None:
+                        pointer = self.s2n(offset, 4)
                     if relative:
-                        tmp_offset = self.s2n(offset, 4)
-                        offset = tmp_offset + ifd - 8
+                        offset = pointer + ifd - 8
                         if self.fake_exif:
                             offset = offset + 18
                     else:
-                        offset = self.s2n(offset, 4)
+                        offset = pointer
 
                 field_offset = offset
                 if field_type == 2:
@@ -1349,14 +1730,21 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        self.use_bytes(count)
+                        values = self.read(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
                     else:
                         values = ''
                 else:
+                    values = None
+                    if count < 1000 or tag_name == 'MakerNote':
+                        self.use_bytes(count * typelen)
+                    if self.bulk_values and (count < 1000 or tag_name == 'MakerNote'
+                                             and field_type not in (5, 10)):
+                        values = self.s2n_values(offset, field_type, count)
+                if values is None:
                     values = []
                     signed = (field_type in [6, 8, 9, 10])
                     
@@ -1376,98 +1764,99 @@ class EXIF_header:
                     # The test above causes problems with tags that are 
                     # supposed to have long values!  Fix up one important case.
                     elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
+                        for dummy in xrange(count):
+                            if dummy & 0xFFFF == 0:
+                                self.check_time()
                             value = self.s2n(offset, typelen, signed)
                             values.append(value)
                             offset = offset + typelen
                     #else :
                     #    print "Warning: dropping large tag:", tag, tag_name
                 
-                # now 'values' is either a string or an array
-                if count == 1 and field_type != 2:
-                    printable=str(values[0])
-                elif count > 50 and len(values) > 20 :
-                    printable=str( values[0:20] )[0:-1] + ", ... ]"
-                else:
-                    printable=str(values)
-
-                # compute printable version of values
-                if tag_entry:
-                    if len(tag_entry) != 1:
-                        # optional 2nd tag element is present
-                        if callable(tag_entry[1]):
-                            # call mapping function
-                            printable = tag_entry[1](values)
-                        else:
-                            printable = ''
-                            for i in values:
-                                # use lookup table for this tag
-                                printable += tag_entry[1].get(i, repr(i))
-
-                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(printable, tag,
+                # now 'values' is either a string or an array; it is
+                # formatted when the printable version is first used
+                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(None, tag,
                                                           field_type,
                                                           values, field_offset,
-                                                          count * typelen)
+                                                          count * typelen,
+                                                          count, tag_entry,
+                                                          self.endian)
                 if self.debug:
                     print ' debug:   %s: %s' % (tag_name,
                                                 repr(self.tags[ifd_name + ' ' + tag_name]))
+                if remaining is not None:
+                    remaining.discard(ifd_name + ' ' + tag_name)
+                    if not remaining:
+                        break
 
             if tag_name == stop_tag:
                 break
 
+    # the JPEG thumbnail of length bytes at offset: its data, or where it is
+    # in the file in 'offset' thumbnail mode
+    def jpeg_thumbnail(self, offset, length):
+        if self.context.thumbnail == 'offset':
+            return ThumbnailRef(self.offset + offset, length)
+        self.use_bytes(length)
+        return self.read(offset, length)
+
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
     # much as possible
     def extract_TIFF_thumbnail(self, thumb_ifd):
         entries = self.s2n(thumb_ifd, 2)
-        # this is header plus offset to IFD ...
-        if self.endian == 'M':
-            tiff = 'MM\x00*\x00\x00\x00\x08'
-        else:
-            tiff = 'II*\x00\x08\x00\x00\x00'
-        # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
-
-        # fix up large value offset pointers into data area
+        self.use_bytes(entries*12+2)
+        ifd = self.read(thumb_ifd, entries*12+2)
+
+        # the thumbnail is laid out as a header, the thumbnail IFD, a null
+        # "next IFD" pointer, the values that do not fit in their entries
+        # and the pixel strips, in one preallocated bytearray
+        size = 8 + len(ifd) + 4
+        fields = []
+        strip_ptr = None
         for i in range(entries):
             entry = thumb_ifd + 2 + 12 * i
             tag = self.s2n(entry, 2)
             field_type = self.s2n(entry+2, 2)
+            if not 0 < field_type < len(FIELD_TYPES):
+                continue
             typelen = FIELD_TYPES[field_type][0]
             count = self.s2n(entry+4, 4)
-            oldoff = self.s2n(entry+8, 4)
             # start of the 4-byte pointer area in entry
             ptr = i * 12 + 18
-            # remember strip offsets location
-            if tag == 0x0111:
-                strip_off = ptr
-                strip_len = count * typelen
             # is it in the data area?
             if count * typelen > 4:
-                # update offset pointer (nasty "strings are immutable" crap)
-                # should be able to say "tiff[ptr:ptr+4]=newoff"
-                newoff = len(tiff)
-                tiff = tiff[:ptr] + self.n2s(newoff, 4) + tiff[ptr+4:]
-                # remember strip offsets location
-                if tag == 0x0111:
-                    strip_off = newoff
-                    strip_len = 4
-                # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                fields.append((ptr, self.s2n(entry+8, 4), count * typelen, size))
+                ptr = size
+                size += count * typelen
+            # remember strip offsets location
+            if tag == 0x0111:
+                strip_ptr, strip_len = ptr, typelen
 
-        # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
         old_counts = self.tags['Thumbnail StripByteCounts'].values
-        for i in range(len(old_offsets)):
-            # update offset pointer (more nasty "strings are immutable" crap)
-            offset = self.n2s(len(tiff), strip_len)
-            tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
-            strip_off += strip_len
-            # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+        self.use_bytes(size - 8 - len(ifd) - 4 + sum(old_counts))
+        tiff = bytearray(size + sum(old_counts))
+        if self.endian == 'M':
+            tiff[0:8] = 'MM\x00*\x00\x00\x00\x08'
+        else:
+            tiff[0:8] = 'II*\x00\x08\x00\x00\x00'
+        tiff[8:8 + len(ifd)] = ifd
+
+        # copy the values and point their entries at them
+        for ptr, oldoff, length, newoff in fields:
+            tiff[ptr:ptr + 4] = self.n2s(newoff, 4)
+            data = self.read(oldoff, length)
+            tiff[newoff:newoff + len(data)] = data
+
+        # add pixel strips and update strip offset info
+        for i in range(min(len(old_offsets), len(old_counts))):
+            if strip_ptr is not None:
+                tiff[strip_ptr:strip_ptr + strip_len] = self.n2s(size, strip_len)
+                strip_ptr += strip_len
+            data = self.read(old_offsets[i], old_counts[i])
+            tiff[size:size + len(data)] = data
+            size += old_counts[i]
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1508,15 +1897,15 @@ class EXIF_header:
         # not at the start of the makernote, it's probably type 2, since some
         # cameras work that way.
         if 'NIKON' in make:
-            if note.values[0:7] == [78, 105, 107, 111, 110, 0, 1]:
+            if list(note.values[0:7]) == [78, 105, 107, 111, 110, 0, 1]:
                 if self.debug:
                     print "Looks like a type 1 Nikon MakerNote."
                 self.dump_IFD(note.field_offset+8, 'MakerNote',
                               dict=MAKERNOTE_NIKON_OLDER_TAGS)
-            elif note.values[0:7] == [78, 105, 107, 111, 110, 0, 2]:
+            elif list(note.values[0:7]) == [78, 105, 107, 111, 110, 0, 2]:
                 if self.debug:
                     print "Looks like a labeled type 2 Nikon MakerNote"
-                if note.values[12:14] != [0, 42] and note.values[12:14] != [42L, 0L]:
+                if list(note.values[12:14]) != [0, 42] and list(note.values[12:14]) != [42L, 0L]:
                     raise ValueError("Missing marker tag '42' in MakerNote.")
                 # skip the Makernote label and the TIFF header
                 self.dump_IFD(note.field_offset+10+8, 'MakerNote',
@@ -1592,40 +1981,182 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# decode an EXIF date and time ('YYYY:MM:DD HH:MM:SS', the format of the
+# DateTime tags) into a datetime, or return None if it is not a valid date.
+def parse_datetime(value):
+    value = str(value)
+    if len(value) < 19 or value[4] != ':' or value[7] != ':' or value[10] != ' ' \
+           or value[13] != ':' or value[16] != ':':
+        return None
+    try:
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        return None
+
+# tags giving the date a picture or movie was taken, most accurate first
+# (to be projected with preferred=True)
+DATE_TAGS = ('EXIF DateTimeOriginal', 'EXIF DateTimeDigitized', 'Image DateTime',
+             'QuickTime CreationDate')
+
+# the tags still looked for by a projection of tags in order of preference:
+# finding one of them leaves only the tags preferred to it.
+class PreferredTags(set):
+    def __init__(self, tags):
+        set.__init__(self, tags)
+        self.order = list(tags)
+
+    def discard(self, tag):
+        if tag in self.order:
+            for less_preferred in self.order[self.order.index(tag):]:
+                set.discard(self, less_preferred)
+        else:
+            set.discard(self, tag)
+
+# return the (IFD names, index of the last IFD in the chain) to walk, and
+# the set of tags needed to find the given projected tags.
+def projection(tags, details):
+    wanted = set(tags)
+    last_ifd = 0
+    for tag in tags:
+        if tag.startswith('Thumbnail ') or tag == 'JPEGThumbnail':
+            last_ifd = max(last_ifd, 1)
+        elif tag.startswith('IFD '):
+            last_ifd = max(last_ifd, int(tag.split(' ')[1]))
+    exif = [tag for tag in tags if tag.startswith('EXIF ') or tag.startswith('MakerNote ')]
+    gps = [tag for tag in tags if tag.startswith('GPS ')]
+    for ifd_name in (['Image', 'Thumbnail'] + ['IFD %d' % i for i in range(2, last_ifd + 1)])[:last_ifd + 1]:
+        if exif:
+            wanted.add(ifd_name + ' ExifOffset')
+        if gps:
+            wanted.add(ifd_name + ' GPSInfo')
+    if details and [tag for tag in tags if tag.startswith('MakerNote ')]:
+        wanted.update(['EXIF MakerNote', 'Image Make'])
+    if 'JPEGThumbnail' in tags:
+        wanted.update(['Thumbnail JPEGInterchangeFormat', 'Thumbnail JPEGInterchangeFormatLength'])
+    return wanted, last_ifd
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
-    # yah it's cheesy...
-    global detailed
-    detailed = details
+#
+# With buffer_header (the default) the header is read into memory once: the
+# whole APP1 segment of a JPEG file, or the first TIFF_BUFFER_SIZE bytes of a
+# TIFF file. Anything outside of it is still read from the file.
+TIFF_BUFFER_SIZE = 2**16
+
+# TIFF files can have their IFDs and values anywhere in the file. Regular
+# files larger than MMAP_THRESHOLD bytes are mapped into memory instead of
+# buffering their start, so nothing is read with seek and read calls (None
+# to never map files).
+MMAP_THRESHOLD = 2**22
+
+# map a regular file larger than MMAP_THRESHOLD, or return None if it
+# cannot be mapped
+def map_file(f):
+    if MMAP_THRESHOLD is None:
+        return None
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size <= MMAP_THRESHOLD:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+#
+# With tags, only the given tags (e.g. DATE_TAGS) are decoded and returned:
+# only the IFDs needed to find them are walked, and parsing stops as soon as
+# all of them have been found. With preferred, tags are in order of
+# preference and only the first one found is needed, so parsing stops as
+# soon as no tag preferred to the ones found is left.
+#
+# Thumbnails are only extracted if asked for: with thumbnail=True, the
+# 'JPEGThumbnail' tag holds the data of the JPEG thumbnail and the
+# 'TIFFThumbnail' tag a bytearray with the uncompressed TIFF thumbnail. With
+# thumbnail='offset', 'JPEGThumbnail' is a ThumbnailRef telling where the
+# JPEG thumbnail is in the file, and nothing is read.
+#
+# Streams that cannot seek, or any stream if stream is true, are parsed
+# reading forward through a buffer (see ParseContext).
+#
+# The settings can also be given as a ParseContext, which overrides the
+# stop_tag, details, strict, debug and thumbnail arguments. The warnings
+# and JPEG segments of the file are added to report, if given.
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False,
+                 buffer_header=True, tags=None, context=None, thumbnail=False,
+                 stream=False, preferred=False, report=None):
+    if context is None:
+        context = ParseContext(details, strict, stop_tag, debug, thumbnail=thumbnail)
+    if report is None:
+        report = ParseReport()
+    if stream or not seekable(f):
+        f = StreamFile(f, context.stream_buffer)
+    try:
+        return parse_file(f, context, buffer_header, tags, preferred, report)
+    except ExifLimitError, e:
+        if context.strict:
+            raise
+        # return what was found before going over the limit
+        report.warn(e.reason, str(e))
+        return select_tags(e.tags, tags)
+
+# parse a file for process_file
+def parse_file(f, context, buffer_header, tags, preferred, report):
+    stop_tag = context.stop_tag
+    debug = context.debug
 
     # by default do not fake an EXIF beginning
     fake_exif = 0
+    header = None
+    mapped = None
 
     # determine whether it's a JPEG or TIFF
     data = f.read(12)
     if data[0:4] in ['II*\x00', 'MM\x00*']:
         # it's a TIFF file
         f.seek(0)
-        endian = f.read(1)
-        f.read(1)
+        if buffer_header:
+            mapped = map_file(f)
+            if mapped is not None:
+                header = mapped
+            else:
+                header = f.read(TIFF_BUFFER_SIZE)
+            endian = header[0]
+        else:
+            endian = f.read(1)
+            f.read(1)
         offset = 0
+    elif data[4:8] in QUICKTIME_ATOMS:
+        # it's a QuickTime or MP4 movie
+        return select_tags(process_quicktime(f, context), tags)
+    elif data[0:4] == '\x00\x00\x01\xBA':
+        # it's an MPEG program stream
+        return select_tags(process_mpeg_ps(data), tags)
     elif data[0:2] == '\xFF\xD8':
-        # it's a JPEG file
-        while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM', 'Phot'):
-            length = ord(data[4])*256+ord(data[5])
-            f.read(length-8)
-            # fake an EXIF beginning of file
-            data = '\xFF\x00'+f.read(10)
-            fake_exif = 1
-        if data[2] == '\xFF' and data[6:10] == 'Exif':
-            # detected EXIF header
-            offset = f.tell()
-            endian = f.read(1)
-        else:
+        # it's a JPEG file: find the Exif APP1 segment, indexing the
+        # segments before it (or all of them when parsing every tag)
+        exif = None
+        for segment in jpeg_segments(f, context):
+            report.segments.append(segment)
+            if exif is None and segment.name == 'Exif' and segment.length > 6:
+                exif = segment
+                if tags is not None:
+                    break
+            elif exif is None:
+                # fake an EXIF beginning of file
+                fake_exif = 1
+        if exif is None:
             # no EXIF information
             return {}
+        # detected EXIF header, which starts after 'Exif\0\0'
+        offset = exif.offset + 6
+        f.seek(offset)
+        if buffer_header:
+            header = f.read(exif.length - 6)
+            endian = header[0:1]
+        else:
+            endian = f.read(1)
     else:
         # file format not recognized
         return {}
@@ -1633,7 +2164,21 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    hdr = EXIF_header(f, endian, offset, fake_exif, context, report=report,
+                      data=header, data_offset=offset, mapped=mapped is not None)
+    try:
+        if tags is not None:
+            return project_file(hdr, f, offset, tags, stop_tag, preferred)
+        return dump_file(hdr, f, offset, stop_tag, debug)
+    except ExifLimitError, e:
+        e.tags = hdr.tags
+        raise
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+# walk all the IFDs of the EXIF header (the default mode of process_file)
+def dump_file(hdr, f, offset, stop_tag, debug):
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
@@ -1671,32 +2216,361 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
 
     # extract uncompressed TIFF thumbnail
     thumb = hdr.tags.get('Thumbnail Compression')
-    if thumb and thumb.printable == 'Uncompressed TIFF':
+    if hdr.context.thumbnail is True and thumb and thumb.values[0] == 1 \
+           and 'Thumbnail StripOffsets' in hdr.tags and 'Thumbnail StripByteCounts' in hdr.tags:
         hdr.extract_TIFF_thumbnail(thumb_ifd)
 
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
-    if thumb_off:
-        f.seek(offset+thumb_off.values[0])
-        size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
+    thumb_len = hdr.tags.get('Thumbnail JPEGInterchangeFormatLength')
+    if hdr.context.thumbnail and thumb_off and thumb_len:
+        hdr.tags['JPEGThumbnail'] = hdr.jpeg_thumbnail(thumb_off.values[0], thumb_len.values[0])
 
     # deal with MakerNote contained in EXIF IFD
     # (Some apps use MakerNote tags but do not use a format for which we
     # have a description, do not process these).
-    if 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and detailed:
+    if 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and hdr.detailed:
         hdr.decode_maker_note()
 
     # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the MakerNote
     # since it's not allowed in a uncompressed TIFF IFD
-    if 'JPEGThumbnail' not in hdr.tags:
+    if hdr.context.thumbnail and 'JPEGThumbnail' not in hdr.tags:
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            hdr.tags['JPEGThumbnail']=hdr.jpeg_thumbnail(thumb_off.values[0], thumb_off.field_length)
 
     return hdr.tags
 
+# projection mode of process_file: walk the IFDs like process_file does,
+# but only as far as needed to find the tags.
+def project_file(hdr, f, offset, tags, stop_tag, preferred=False):
+    wanted, last_ifd = projection(tags, hdr.detailed)
+    remaining = PreferredTags(tags) if preferred else set(tags)
+    i = hdr.first_IFD()
+    ctr = 0
+    while i and ctr <= last_ifd and remaining:
+        if ctr == 0:
+            IFD_name = 'Image'
+        elif ctr == 1:
+            IFD_name = 'Thumbnail'
+        else:
+            IFD_name = 'IFD %d' % ctr
+        hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag, wanted=wanted, remaining=remaining)
+        exif_off = hdr.tags.get(IFD_name+' ExifOffset')
+        if exif_off and remaining:
+            hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag, wanted=wanted, remaining=remaining)
+        gps_off = hdr.tags.get(IFD_name+' GPSInfo')
+        if gps_off and remaining:
+            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag, wanted=wanted, remaining=remaining)
+        i = hdr.next_IFD(i)
+        ctr += 1
+
+    thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
+    thumb_len = hdr.tags.get('Thumbnail JPEGInterchangeFormatLength')
+    if 'JPEGThumbnail' in tags and thumb_off and thumb_len:
+        hdr.tags['JPEGThumbnail'] = hdr.jpeg_thumbnail(thumb_off.values[0], thumb_len.values[0])
+
+    if remaining and 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and hdr.detailed:
+        hdr.decode_maker_note()
+
+    return dict([(tag, hdr.tags[tag]) for tag in tags if tag in hdr.tags])
+
+
+# the tags of a projection, or all of them
+def select_tags(found, tags):
+    if tags is None:
+        return found
+    return dict([(tag, found[tag]) for tag in tags if tag in found])
+
+# a marker segment of a JPEG file: its marker, the offset and length of its
+# data and, for APPn segments, the name of the format of the data (the
+# identifier it starts with, like 'Exif', 'JFIF', 'ICC_PROFILE' or
+# 'http://ns.adobe.com/xap/1.0/' for XMP)
+JpegSegment = collections.namedtuple('JpegSegment', 'marker offset length name')
+
+# walk the marker segments of a JPEG file, up to the start of the image data
+# (SOS), generating a JpegSegment for each of them. Only the segment headers
+# are read.
+def jpeg_segments(f, context):
+    pos = 2
+    segments = 0
+    while True:
+        f.seek(pos)
+        data = f.read(36)
+        if len(data) < 2 or data[0] != '\xFF':
+            return
+        marker = ord(data[1])
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # markers without a segment
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA) or len(data) < 4:
+            # end of image or start of scan
+            return
+        length = ord(data[2])*256+ord(data[3])
+        if length < 2:
+            return
+        segments += 1
+        if context.max_entries is not None and segments > context.max_entries:
+            return
+        name = ''
+        if 0xE0 <= marker <= 0xEF:
+            name = data[4:4 + min(length - 2, 32)].split('\x00', 1)[0]
+        yield JpegSegment(marker, pos + 4, length - 2, name)
+        pos += 2 + length
+
+# top level atoms a QuickTime or MP4 file can start with
+QUICKTIME_ATOMS = ('ftyp', 'moov', 'mdat', 'wide', 'free', 'skip', 'pnot')
+
+# seconds from the QuickTime epoch (1904-01-01) to the Unix epoch
+QUICKTIME_EPOCH = 2082844800
+
+# walk the atoms of a QuickTime or MP4 file from offset start to end (None
+# for the end of the file), generating the (type, offset of the data, size
+# of the data) of each of them. Atom data is skipped by seeking, so only
+# the 8 or 16 byte atom headers are read.
+def quicktime_atoms(f, start, end, context):
+    pos = start
+    atoms = 0
+    while end is None or pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>L4s', header)
+        data = pos + 8
+        if size == 1:
+            # 64 bit size following the type
+            largesize = f.read(8)
+            if len(largesize) < 8:
+                return
+            size = struct.unpack('>Q', largesize)[0]
+            data = pos + 16
+        elif size == 0:
+            # atom extending to the end of the file
+            yield kind, data, None
+            return
+        if size < data - pos:
+            return
+        atoms += 1
+        if context.max_entries is not None and atoms > context.max_entries:
+            return
+        yield kind, data, size - (data - pos)
+        pos += size
+
+# convert a QuickTime time stamp into an EXIF date in local time
+def quicktime_date(seconds):
+    if seconds == 0:
+        return None
+    try:
+        return datetime.datetime.fromtimestamp(seconds - QUICKTIME_EPOCH).strftime('%Y:%m:%d %H:%M:%S')
+    except (ValueError, OverflowError):
+        return None
+
+# read the creation and modification dates of the movie from the movie
+# header atom (moov/mvhd) of a QuickTime or MP4 file
+def process_quicktime(f, context):
+    tags = {}
+    for kind, offset, size in quicktime_atoms(f, 0, None, context):
+        if kind != 'moov':
+            continue
+        for kind, offset, size in quicktime_atoms(f, offset, size is not None and offset + size or None, context):
+            if kind != 'mvhd':
+                continue
+            f.seek(offset)
+            data = f.read(20)
+            if len(data) < 12:
+                return tags
+            if data[0] == '\x01' and len(data) == 20:
+                created, modified = struct.unpack('>QQ', data[4:20])
+            else:
+                created, modified = struct.unpack('>LL', data[4:12])
+            for name, seconds in (('CreationDate', created), ('ModificationDate', modified)):
+                date = quicktime_date(seconds)
+                if date:
+                    tags['QuickTime ' + name] = IFD_Tag(date, 0, 2, date, offset + 4, len(data) == 20 and 8 or 4)
+            return tags
+        return tags
+    return tags
+
+# MPEG program streams have no creation date: their pack headers only hold
+# the system clock reference, relative to the start of the stream. This
+# only tells MPEG-1 and MPEG-2 streams apart.
+def process_mpeg_ps(data):
+    if len(data) < 5:
+        return {}
+    if ord(data[4]) >> 6 == 1:
+        version = 'MPEG-2'
+    else:
+        version = 'MPEG-1'
+    return {'MPEG Version': IFD_Tag(version, 0, 2, version, 4, 1)}
+
+# result of parsing one file with process_files: the path, the tags (empty
+# if there was an error), the error message or None, the time spent parsing
+# the file, the number of bytes read from it (or used from its memory
+# mapping), and the ParseWarnings and JpegSegments of its ParseReport.
+ExifResult = collections.namedtuple('ExifResult', 'path tags error seconds bytes_read warnings segments')
+
+# file wrapper counting the bytes read from a file
+class CountingFile(object):
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def fileno(self):
+        return self.f.fileno()
+
+# parse the file at path, catching errors (called in the workers of
+# process_files, so it has to be a module level function)
+def process_path(job):
+    path, kwargs = job
+    start = time.time()
+    f = None
+    report = ParseReport()
+    try:
+        f = CountingFile(open(path, 'rb'))
+        try:
+            tags = process_file(f, report=report, **kwargs)
+        finally:
+            f.f.close()
+        return ExifResult(path, tags, None, time.time() - start, f.bytes_read + report.bytes_mapped,
+                          report.warnings, report.segments)
+    except Exception, e:
+        return ExifResult(path, {}, '%s: %s' % (e.__class__.__name__, e),
+                          time.time() - start, (f and f.bytes_read or 0) + report.bytes_mapped,
+                          report.warnings, report.segments)
+
+# parse a list of files using workers threads (backend='thread') or processes
+# (backend='process'), generating an ExifResult for each of them, in the
+# order of paths if ordered is true or as soon as they are parsed otherwise.
+# The other arguments are passed to process_file. Parsing is CPU bound, so
+# only processes use more than one core. paths can be any iterable, such as
+# the generator returned by walk_paths.
+#
+# A pool made by the caller (e.g. a multiprocessing.Pool created before the
+# program starts any thread, since forking a threaded process can deadlock
+# its children) can be given instead of a backend; it is left running.
+def process_files(paths, workers=1, backend='thread', ordered=True, pool=None, **kwargs):
+    jobs = itertools.izip(paths, itertools.repeat(kwargs))
+    if pool is not None:
+        if ordered:
+            results = pool.imap(process_path, jobs)
+        else:
+            results = pool.imap_unordered(process_path, jobs)
+        for result in results:
+            yield result
+        return
+    if hasattr(paths, '__len__'):
+        workers = min(workers, len(paths))
+    if workers <= 1:
+        for result in itertools.imap(process_path, jobs):
+            yield result
+        return
+    if backend == 'thread':
+        pool = multiprocessing.pool.ThreadPool(workers)
+    elif backend == 'process':
+        pool = multiprocessing.Pool(workers)
+    else:
+        raise ValueError('unknown backend %r' % backend)
+    try:
+        if ordered:
+            results = pool.imap(process_path, jobs)
+        else:
+            results = pool.imap_unordered(process_path, jobs)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# generate the files named in paths, and the files found in the directories
+# named in it and their subdirectories, in name order
+def walk_paths(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+# text of a file name or tag value for JSON output: file names and tag
+# values are byte strings, mostly UTF-8 but sometimes in other encodings
+def json_text(s):
+    if isinstance(s, unicode):
+        return s
+    return s.decode('utf-8', 'replace')
+
+# one line of JSON output for an ExifResult
+def json_line(result):
+    tags = {}
+    for tag, value in result.tags.iteritems():
+        if tag not in ('JPEGThumbnail', 'TIFFThumbnail'):
+            tags[tag] = json_text(value.printable)
+    return json.dumps({'path': json_text(result.path), 'tags': tags, 'error': result.error},
+                      sort_keys=True)
+
+# parsing statistics of the command line tool: the files parsed, the bytes
+# read from them and per camera make, the number of files parsed in each
+# range of parse times.
+class ParseStats:
+    # upper bounds of the parse time ranges, in milliseconds
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.start = time.time()
+        self.files = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.makes = {}
+
+    def add(self, result):
+        self.files += 1
+        if result.error:
+            self.errors += 1
+        self.bytes_read += result.bytes_read
+        make = result.tags.get('Image Make')
+        if make:
+            make = str(make).strip() or 'unknown'
+        else:
+            make = 'unknown'
+        if make not in self.makes:
+            self.makes[make] = [0] * (len(self.BUCKETS) + 1)
+        ms = result.seconds * 1000
+        bucket = 0
+        while bucket < len(self.BUCKETS) and ms >= self.BUCKETS[bucket]:
+            bucket += 1
+        self.makes[make][bucket] += 1
+
+    def report(self, out):
+        seconds = max(time.time() - self.start, 1e-6)
+        print >> out, '%d files (%d errors) in %.2fs: %.1f files/s, %d bytes read (%.1f MB/s)' % \
+              (self.files, self.errors, seconds, self.files / seconds,
+               self.bytes_read, self.bytes_read / seconds / 2**20)
+        labels = ['<%dms' % ms for ms in self.BUCKETS] + ['>=%dms' % self.BUCKETS[-1]]
+        for make in sorted(self.makes):
+            counts = self.makes[make]
+            print >> out, '%s: %d files' % (make, sum(counts))
+            for label, count in zip(labels, counts):
+                if count:
+                    print >> out, '   %8s %d' % (label, count)
 
 # show command line usage
 def usage(exit_status):
@@ -1706,17 +2580,22 @@ def usage(exit_status):
     msg += '-t TAG --stop-tag TAG   Stop processing when this tag is retrieved.\n'
     msg += '-s --strict   Run in strict mode (stop on errors).\n'
     msg += '-d --debug   Run in debug mode (display extra info).\n'
+    msg += '-j --jsonl   Print one line of JSON per file.\n'
+    msg += '-T TAGS --tags TAGS   Only read these tags (comma separated names).\n'
+    msg += '-w N --workers N   Parse files in N processes.\n'
+    msg += '-S --stats   Print parsing statistics to stderr.\n'
+    msg += 'Directories are searched for files recursively.\n'
     print msg
     sys.exit(exit_status)
 
 # library test/debug function (dump given files)
 if __name__ == '__main__':
-    import sys
     import getopt
 
     # parse command line options/arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:v", ["help", "quick", "strict", "debug", "stop-tag="])
+        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:vjT:w:S", ["help", "quick", "strict", "debug", "stop-tag=",
+                                                                  "jsonl", "tags=", "workers=", "stats"])
     except getopt.GetoptError:
         usage(2)
     if args == []:
@@ -1725,6 +2604,10 @@ if __name__ == '__main__':
     stop_tag = 'UNDEF'
     debug = False
     strict = False
+    jsonl = False
+    tags = None
+    workers = 1
+    stats = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage(0)
@@ -1736,32 +2619,65 @@ if __name__ == '__main__':
             strict = True
         if o in ("-d", "--debug"):
             debug = True
+        if o in ("-j", "--jsonl"):
+            jsonl = True
+        if o in ("-T", "--tags"):
+            tags = [tag.strip() for tag in a.split(',') if tag.strip()]
+        if o in ("-w", "--workers"):
+            try:
+                workers = int(a)
+            except ValueError:
+                usage(2)
+        if o in ("-S", "--stats"):
+            stats = ParseStats()
 
-    # output info for each file
-    for filename in args:
-        try:
-            file=open(filename, 'rb')
-        except:
-            print "'%s' is unreadable\n"%filename
-            continue
-        print filename + ':'
-        # get the tags
-        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug)
-        if not data:
-            print 'No EXIF information found'
-            continue
+    # the make is read for the statistics even if it is not printed
+    wanted = tags
+    if tags is not None and stats and 'Image Make' not in tags:
+        wanted = tags + ['Image Make']
 
-        x=data.keys()
-        x.sort()
-        for i in x:
-            if i in ('JPEGThumbnail', 'TIFFThumbnail'):
+    # output info for each file
+    results = process_files(walk_paths(args), workers=workers, backend='process',
+                            stop_tag=stop_tag, details=detailed, strict=strict,
+                            debug=debug, thumbnail=not jsonl, tags=wanted)
+    try:
+        for result in results:
+            filename, data, error = result[:3]
+            if stats:
+                stats.add(result)
+            if wanted is not tags:
+                data.pop('Image Make', None)
+            if jsonl:
+                print json_line(result)
+                continue
+            if error:
+                print "'%s' is unreadable (%s)\n" % (filename, error)
+                continue
+            print filename + ':'
+            if not data:
+                print 'No EXIF information found'
                 continue
-            try:
-                print '   %s (%s): %s' % \
-                      (i, FIELD_TYPES[data[i].field_type][2], data[i].printable)
-            except:
-                print 'error', i, '"', data[i], '"'
-        if 'JPEGThumbnail' in data:
-            print 'File has JPEG thumbnail'
-        print
 
+            x=data.keys()
+            x.sort()
+            for i in x:
+                if i in ('JPEGThumbnail', 'TIFFThumbnail'):
+                    continue
+                try:
+                    print '   %s (%s): %s' % \
+                          (i, FIELD_TYPES[data[i].field_type][2], data[i].printable)
+                except (IndexError, UnicodeError):
+                    print 'error', i, '"', data[i], '"'
+            if 'JPEGThumbnail' in data:
+                print 'File has JPEG thumbnail'
+            print
+    except IOError, e:
+        # the reader went away (e.g. piped into head): stop quietly
+        if e.errno != errno.EPIPE:
+            raise
+        results.close()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+    if stats:
+        stats.report(sys.stderr)
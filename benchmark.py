@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+#
+# Benchmarks for picasa-directory-sync.
+#
+# Usage: benchmark.py BENCHMARK [OPTIONS]
+#
+# Each benchmark generates its own input in a temporary directory (unless
+# told otherwise) and prints the timings of the implementations it compares.
+
+import os
+import sys
+import time
+import random
+import struct
+import json
+import gc
+import warnings
+import collections
+import getopt
+import itertools
+import shutil
+import tempfile
+import StringIO
+import multiprocessing.pool
+
+import sync
+import EXIF
+import exifgen
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def best_of(repeat, func, *args, **kwargs):
+    best = None
+    for dummy in range(repeat):
+        elapsed, result = timed(func, *args, **kwargs)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+# generate a photo tree with the given number of files spread over nested
+# directories, mixing included, not included and excluded names.
+def generate_tree(root, files, files_per_dir=50, depth=3):
+    extensions = ('.jpg', '.JPG', '.png', '.mov', '.txt', '.xmp')
+    dirs = []
+    for i in range(max(1, files // files_per_dir)):
+        parts = ['d%d' % ((i // (10 ** level)) % 10) for level in range(depth)]
+        parts.append('album%d' % i)
+        if i % 20 == 0:
+            parts.append('.DS_Store')
+        dirs.append(os.path.join(root, *parts))
+    for i in range(files):
+        directory = dirs[i % len(dirs)]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, 'IMG_%06d%s' % (i, extensions[i % len(extensions)]))
+        with open(filename, 'wb') as f:
+            f.write('x' * (i % 512))
+
+# walk with the old walker, stat'ing every file like _load_file_data_list did.
+def walk_glob(root, include_files, exclude_dirs):
+    result = []
+    for filename in sync.GlobDirectoryWalker(root, include_files, exclude_dirs):
+        result.append((filename, os.path.getsize(filename), os.path.getmtime(filename)))
+    return result
+
+def walk_scandir(root, include_files, exclude_dirs):
+    include_matcher = sync.PatternMatcher(include_files)
+    exclude_matcher = sync.PatternMatcher(exclude_dirs)
+    return [(entry.path, entry.stat.st_size, entry.stat.st_mtime)
+            for entry in sync.ScandirWalker(root, include_matcher, exclude_matcher)]
+
+def bench_walker(opts, args):
+    files = int(opts.get('--files', 20000))
+    repeat = int(opts.get('--repeat', 3))
+    include_files = ["*.jpg", "*.jpeg", "*.bmp", "*.gif", "*.png", "*.mov", "*.mpg"]
+    exclude_dirs = ["*/.DS_Store"]
+
+    root = opts.get('--dir') or tempfile.mkdtemp(prefix='picasa-bench-')
+    try:
+        if '--dir' not in opts:
+            print "Generating %d files in %s" % (files, root)
+            generate_tree(root, files)
+        glob_time, glob_result = best_of(repeat, walk_glob, root, include_files, exclude_dirs)
+        scandir_time, scandir_result = best_of(repeat, walk_scandir, root, include_files, exclude_dirs)
+        assert sorted(glob_result) == sorted(scandir_result), "walkers disagree"
+        print "%d matching files" % len(scandir_result)
+        print "GlobDirectoryWalker: %.3fs" % glob_time
+        print "ScandirWalker:       %.3fs (%.1fx, scandir %s)" % (
+            scandir_time, glob_time / max(scandir_time, 1e-9),
+            'available' if sync.scandir is not None else 'not available')
+    finally:
+        if '--dir' not in opts:
+            shutil.rmtree(root)
+
+class SlowFile(object):
+    # file wrapper adding a fixed latency to every read, like a network mount.
+    def __init__(self, f, latency):
+        self.f = f
+        self.latency = latency
+
+    def read(self, *args):
+        time.sleep(self.latency)
+        return self.f.read(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+class Quiet(object):
+    # swallow what the sync prints while timing it.
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def load_album(root, workers):
+    album = sync.Album(root, u'bench', sync.PatternMatcher('*.jpg'), None,
+                       verify_checksums=True, worker_threads=workers)
+    with Quiet():
+        album._load_file_data_list()
+    return [(d['filename'], d['checksum']) for d in album.file_data_list]
+
+def bench_hashing(opts, args):
+    files = int(opts.get('--files', 200))
+    size = int(opts.get('--size', 2**20))
+    workers = int(opts.get('--workers', sync.default_worker_threads()))
+    latency = float(opts.get('--latency', 0.005))
+    repeat = int(opts.get('--repeat', 3))
+
+    root = tempfile.mkdtemp(prefix='picasa-bench-')
+    try:
+        print "Generating %d files of %d bytes in %s" % (files, size, root)
+        for i in range(files):
+            with open(os.path.join(root, 'IMG_%06d.jpg' % i), 'wb') as f:
+                f.write(os.urandom(size))
+        total_mb = files * size / float(2**20)
+        for name, latency in (('local', 0), ('latency %gs/read' % latency, latency)):
+            if latency:
+                sync.open = lambda filename, *args: (SlowFile(open(filename, *args), latency)
+                                                     if filename.endswith('.jpg') else open(filename, *args))
+            try:
+                serial_time, serial_result = best_of(repeat, load_album, root, 1)
+                pool_time, pool_result = best_of(repeat, load_album, root, workers)
+            finally:
+                if latency:
+                    del sync.open
+            assert serial_result == pool_result, "results differ"
+            print "%s: 1 thread %.1f MB/s, %d threads %.1f MB/s (%.1fx)" % (
+                name, total_mb / serial_time, workers, total_mb / pool_time,
+                serial_time / max(pool_time, 1e-9))
+    finally:
+        shutil.rmtree(root)
+
+def bench_hashes(opts, args):
+    # Hashing speed of each checksum algorithm on the given (large) files,
+    # or on generated files.
+    files = int(opts.get('--files', 2))
+    size = int(opts.get('--size', 2**28))
+    repeat = int(opts.get('--repeat', 3))
+    root = None
+    paths = find_files(args)
+    if not paths:
+        root = tempfile.mkdtemp(prefix='picasa-bench-')
+        print "Generating %d files of %d bytes in %s" % (files, size, root)
+        for i in range(files):
+            path = os.path.join(root, 'MVI_%04d.mov' % i)
+            with open(path, 'wb') as f:
+                for dummy in range(0, size, 2**20):
+                    f.write(os.urandom(min(2**20, size - f.tell())))
+            paths.append(path)
+    try:
+        total = sum([os.path.getsize(generated) for generated in paths])
+        print "%d files, %d bytes, %d hashing threads for tree hashes" % (
+            len(paths), total, sync.default_worker_threads())
+        for algorithm in sync.hash_algorithms():
+            def hash_files():
+                for path in paths:
+                    with open(path, 'rb') as f:
+                        sync.checksum_for_file(f, algorithm)
+            elapsed, dummy = best_of(repeat, hash_files)
+            print "%s: %.2f GB/s" % (algorithm, total / max(elapsed, 1e-9) / 2**30)
+    finally:
+        if root:
+            shutil.rmtree(root)
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, dirnames, filenames in os.walk(path):
+                files.extend([os.path.join(directory, filename) for filename in sorted(filenames)])
+        else:
+            files.append(path)
+    return files
+
+def parse_files(contents, **kwargs):
+    for data in contents:
+        EXIF.process_file(StringIO.StringIO(data), **kwargs)
+
+def parse_result(data, details, bulk_values=True, buffer_header=False):
+    context = EXIF.ParseContext(details=details, bulk_values=bulk_values)
+    tags = EXIF.process_file(StringIO.StringIO(data), context=context, buffer_header=buffer_header)
+    return dict([(key, str(tag)) for key, tag in tags.items()])
+
+def bench_exif(opts, args):
+    repeat = int(opts.get('--repeat', 3))
+    details = '--quick' not in opts
+    files = find_files(args)
+    if not files:
+        usage(2)
+    contents = [open(filename, 'rb').read() for filename in files]
+    print "%d files, %s" % (len(files), details and 'with MakerNotes' or 'without MakerNotes')
+    for name, buffer_header, bulk_values in (('seek+read per value', False, False),
+                                             ('buffered header', True, False),
+                                             ('buffered header, bulk values', True, True)):
+        context = EXIF.ParseContext(details=details, bulk_values=bulk_values)
+        elapsed, dummy = best_of(repeat, parse_files, contents, buffer_header=buffer_header, context=context)
+        print "%s: %.1f files/s" % (name, len(files) / max(elapsed, 1e-9))
+    # the fastest mode must decode the files as reading value by value does
+    different = [filename for filename, data in zip(files, contents)
+                 if parse_result(data, details, bulk_values=False) != parse_result(data, details, buffer_header=True)]
+    print "%d files decoded differently from a buffered header in bulk" % len(different)
+    for filename in different:
+        print "  %s" % filename
+    if different:
+        sys.exit(1)
+
+def generate_sparse_tiff(filename, size, entries=200, strips=2000):
+    # Write a sparse TIFF file of the given size whose tag values, strip
+    # tables and EXIF IFD are spread over the whole file.
+    step = size // (entries + 4)
+    fields = []
+    for i in range(entries):
+        field_type, count = ((2, 20), (3, 50), (4, 100), (5, 4))[i % 4]
+        fields.append((0xC000 + i, field_type, count, ''.join([chr(65 + (i + j) % 26) for j in range(
+            count * {2: 1, 3: 2, 4: 4, 5: 8}[field_type])])))
+    fields.append((0x0111, 4, strips, ''.join([struct.pack('>L', 8 + i * 16) for i in range(strips)])))
+    fields.append((0x0117, 4, strips, struct.pack('>L', 16) * strips))
+    fields.append((0x8769, 4, 1, None))
+    fields.sort()
+    with open(filename, 'wb') as f:
+        f.write('MM\x00*' + struct.pack('>L', 8))
+        ifd = struct.pack('>H', len(fields))
+        pos = step
+        for tag, field_type, count, data in fields:
+            if data is None:
+                exif_ifd = size - 64
+                ifd += struct.pack('>HHLL', tag, field_type, count, exif_ifd)
+                continue
+            ifd += struct.pack('>HHLL', tag, field_type, count, pos)
+            f.seek(pos)
+            f.write(data)
+            pos += step
+        f.seek(8)
+        f.write(ifd + '\x00\x00\x00\x00')
+        f.seek(exif_ifd)
+        f.write(struct.pack('>HHHLL', 1, 0x9003, 2, 20, exif_ifd + 32) + '\x00' * 4)
+        f.seek(exif_ifd + 32)
+        f.write('2010:05:06 07:08:09\x00')
+
+def parse_paths(paths, **kwargs):
+    return [dict([(key, str(tag)) for key, tag in EXIF.process_file(open(path, 'rb'), **kwargs).items()])
+            for path in paths]
+
+def bench_tiff(opts, args):
+    files = int(opts.get('--files', 3))
+    size = int(opts.get('--size', 300 * 2**20))
+    repeat = int(opts.get('--repeat', 3))
+    root = tempfile.mkdtemp(prefix='picasa-bench-')
+    threshold = EXIF.MMAP_THRESHOLD
+    try:
+        print "Generating %d sparse TIFF files of %d bytes in %s" % (files, size, root)
+        paths = [os.path.join(root, 'IMG_%06d.tif' % i) for i in range(files)]
+        for path in paths:
+            generate_sparse_tiff(path, size)
+        results = []
+        for name, mmap_threshold, buffer_header in (('seek+read per value', None, False),
+                                                    ('buffered start of file', None, True),
+                                                    ('mapped file', threshold, True)):
+            EXIF.MMAP_THRESHOLD = mmap_threshold
+            elapsed, result = best_of(repeat, parse_paths, paths, buffer_header=buffer_header)
+            results.append(result)
+            print "%s: %.1f files/s" % (name, files / max(elapsed, 1e-9))
+        assert results[0] == results[1] == results[2], "results differ"
+    finally:
+        EXIF.MMAP_THRESHOLD = threshold
+        shutil.rmtree(root)
+
+class DictTag:
+    # IFD_Tag as it was before it had __slots__ and a lazy printable.
+    def __init__(self, tag):
+        self.printable = tag.printable
+        self.tag = tag.tag
+        self.field_type = tag.field_type
+        self.field_offset = tag.field_offset
+        self.field_length = tag.field_length
+        self.values = tag.values
+
+def tags_size(tags):
+    # bytes used by the tag objects of the tag dicts, and their printables
+    # if they have been formatted (values are left out)
+    size = 0
+    for tag in itertools.chain(*[file_tags.itervalues() for file_tags in tags]):
+        if isinstance(tag, (str, bytearray)):
+            # thumbnails
+            size += sys.getsizeof(tag)
+        elif isinstance(tag, DictTag):
+            size += sys.getsizeof(tag) + sys.getsizeof(tag.__dict__) + sys.getsizeof(tag.printable)
+        else:
+            size += sys.getsizeof(tag)
+            if tag._format is None:
+                size += sys.getsizeof(tag._printable)
+    return size
+
+def bench_memory(opts, args):
+    # Size of the tag dicts of a full parse of the files, with the tags
+    # formatted lazily and as they used to be.
+    files = find_files(args)
+    if not files:
+        usage(2)
+    contents = [open(filename, 'rb').read() for filename in files]
+    elapsed, lazy = timed(lambda: [EXIF.process_file(StringIO.StringIO(data)) for data in contents])
+    print "%d files, %d tags, parsed at %.1f files/s" % (
+        len(files), sum([len(tags) for tags in lazy]), len(files) / max(elapsed, 1e-9))
+    print "unformatted tags: %d bytes" % tags_size(lazy)
+    eager = [dict([(key, isinstance(tag, str) and tag or DictTag(tag)) for key, tag in tags.iteritems()])
+             for tags in lazy]
+    print "formatted tags:   %d bytes" % tags_size(lazy)
+    print "dict based tags:  %d bytes" % tags_size(eager)
+
+def bench_threads(opts, args):
+    # Parse the files from several threads at once, alternating the detail
+    # level, and check the results against parsing them one by one.
+    threads = int(opts.get('--threads', 8))
+    repeat = int(opts.get('--repeat', 3))
+    files = find_files(args)
+    if not files:
+        usage(2)
+    contents = [open(filename, 'rb').read() for filename in files]
+    jobs = [(data, details) for data in contents for details in (True, False)] * repeat
+    expected = [parse_result(data, details) for data, details in jobs]
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        elapsed, results = timed(pool.map, lambda job: parse_result(*job), jobs, 1)
+    finally:
+        pool.terminate()
+    mismatches = [files[(i // 2) % len(files)] for i in range(len(jobs)) if results[i] != expected[i]]
+    print "%d parses in %d threads: %.1f files/s, %d mismatches" % (
+        len(jobs), threads, len(jobs) / max(elapsed, 1e-9), len(mismatches))
+    for filename in sorted(set(mismatches)):
+        print "  %s" % filename
+    if mismatches:
+        sys.exit(1)
+
+def exif_start(data):
+    # offset of the TIFF header in a JPEG or TIFF file, or None
+    if data[0:2] == '\xFF\xD8':
+        start = data.find('Exif\x00\x00')
+        return start >= 0 and start + 6 or None
+    if data[0:4] in ('II*\x00', 'MM\x00*'):
+        return 0
+    return None
+
+def make_cyclic(data):
+    # point the next IFD pointer of IFD0 back at IFD0
+    start = exif_start(data)
+    fmt = data[start] == 'I' and '<' or '>'
+    ifd0 = struct.unpack(fmt + 'L', data[start + 4:start + 8])[0]
+    entries = struct.unpack(fmt + 'H', data[start + ifd0:start + ifd0 + 2])[0]
+    pos = start + ifd0 + 2 + 12 * entries
+    return data[:pos] + struct.pack(fmt + 'L', ifd0) + data[pos + 4:]
+
+def mutate(data, rand):
+    # overwrite a few bytes of the EXIF header with random bytes, or with
+    # small numbers that look like offsets and counts
+    data = bytearray(data)
+    start = exif_start(str(data))
+    end = min(len(data), start + 2**16) - 4
+    for dummy in range(rand.randint(1, 8)):
+        pos = rand.randint(start + 8, end)
+        if rand.random() < 0.5:
+            data[pos] = rand.randint(0, 255)
+        else:
+            data[pos:pos + 4] = struct.pack('<L', rand.choice((rand.randint(0, end - start), 0xFFFF, 0xFFFFFFFF)))
+    return str(data)
+
+def bench_fuzz(opts, args):
+    # Parse mutated copies of the given files and report the worst case
+    # parse time, checking that the limits keep it bounded.
+    mutants = int(opts.get('--mutants', 100))
+    seed = int(opts.get('--seed', 0))
+    max_time = float(opts.get('--max-time', 1.0))
+    files = [filename for filename in find_files(args)
+             if exif_start(open(filename, 'rb').read(2**16)) is not None]
+    if not files:
+        usage(2)
+    rand = random.Random(seed)
+    times = []
+    reasons = collections.defaultdict(int)
+    errors = collections.defaultdict(int)
+    context = EXIF.ParseContext(max_time=max_time)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', EXIF.ExifWarning)
+        for filename in files:
+            data = open(filename, 'rb').read()
+            inputs = [make_cyclic(data)] + [mutate(data, rand) for dummy in range(mutants)]
+            for data in inputs:
+                report = EXIF.ParseReport()
+                try:
+                    elapsed, tags = timed(EXIF.process_file, StringIO.StringIO(data), context=context, report=report)
+                    times.append(elapsed)
+                except Exception, e:
+                    errors[e.__class__.__name__] += 1
+                    continue
+                for warning in report.warnings:
+                    reasons[warning.reason] += 1
+    times.sort()
+    print "%d files parsed, %d raised an error" % (len(times) + sum(errors.values()), sum(errors.values()))
+    print "median %.2f ms, 99th percentile %.2f ms, worst %.2f ms" % (
+        times[len(times) // 2] * 1000, times[len(times) * 99 // 100] * 1000, times[-1] * 1000)
+    for reason, count in sorted(reasons.items()):
+        print "  warning %s: %d" % (reason, count)
+    for name, count in sorted(errors.items()):
+        print "  error %s: %d" % (name, count)
+
+# process_file arguments of the parsing modes timed by the regress benchmark
+REGRESS_MODES = [
+    ('quick', {'details': False}),
+    ('detailed', {'details': True}),
+    ('date', {'details': False, 'tags': EXIF.DATE_TAGS, 'preferred': True}),
+    ('thumbnail', {'details': True, 'thumbnail': True}),
+    ]
+
+def measure_mode(contents, repeat, kwargs):
+    # files/s of parsing the files in a mode, and the objects and tag bytes
+    # per file kept by the results
+    elapsed, dummy = best_of(repeat, parse_files, contents, **kwargs)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        results = [EXIF.process_file(StringIO.StringIO(data), **kwargs) for data in contents]
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return {'files_per_s': len(contents) / max(elapsed, 1e-9),
+            'objects_per_file': float(objects) / len(contents),
+            'bytes_per_file': float(tags_size(results)) / len(contents)}
+
+def bench_regress(opts, args):
+    # Time parsing a generated corpus in each mode and compare the results
+    # with a baseline saved by an earlier run, failing if files/s dropped or
+    # the memory kept per file grew by more than the threshold.
+    count = int(opts.get('--files', 200))
+    seed = int(opts.get('--seed', 0))
+    repeat = int(opts.get('--repeat', 5))
+    threshold = float(opts.get('--threshold', 20)) / 100
+    contents = [data for name, data in exifgen.generate_corpus(seed, count)]
+    print "%d generated files (seed %d), %d bytes" % (count, seed, sum(map(len, contents)))
+    results = {'files': count, 'seed': seed, 'modes': {}}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', EXIF.ExifWarning)
+        for mode, kwargs in REGRESS_MODES:
+            result = measure_mode(contents, repeat, kwargs)
+            results['modes'][mode] = result
+            print "%-10s %8.1f files/s %8.1f objects/file %8.1f tag bytes/file" % (
+                mode, result['files_per_s'], result['objects_per_file'], result['bytes_per_file'])
+    if '--save' in opts:
+        f = open(opts['--save'], 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+        print "baseline saved to %s" % opts['--save']
+    if '--baseline' not in opts:
+        return
+    baseline = json.load(open(opts['--baseline']))
+    if (baseline['files'], baseline['seed']) != (count, seed):
+        print "baseline was measured on %d files with seed %d, not comparing" % (baseline['files'], baseline['seed'])
+        sys.exit(2)
+    regressions = []
+    for mode, kwargs in REGRESS_MODES:
+        old = baseline['modes'].get(mode)
+        if not old:
+            continue
+        new = results['modes'][mode]
+        if new['files_per_s'] < old['files_per_s'] * (1 - threshold):
+            regressions.append("%s: %.1f files/s, was %.1f" % (mode, new['files_per_s'], old['files_per_s']))
+        for key in ('objects_per_file', 'bytes_per_file'):
+            if new[key] > old[key] * (1 + threshold) + 1:
+                regressions.append("%s: %.1f %s, was %.1f" % (mode, new[key], key, old[key]))
+    for regression in regressions:
+        print "  regression %s" % regression
+    print "%d regressions beyond %d%% of the baseline" % (len(regressions), threshold * 100)
+    if regressions:
+        sys.exit(1)
+
+BENCHMARKS = {
+    'walker': (bench_walker, ['files=', 'repeat=', 'dir=']),
+    'hashing': (bench_hashing, ['files=', 'size=', 'workers=', 'latency=', 'repeat=']),
+    'hashes': (bench_hashes, ['files=', 'size=', 'repeat=']),
+    'exif': (bench_exif, ['repeat=', 'quick']),
+    'threads': (bench_threads, ['threads=', 'repeat=']),
+    'memory': (bench_memory, []),
+    'fuzz': (bench_fuzz, ['mutants=', 'seed=', 'max-time=']),
+    'tiff': (bench_tiff, ['files=', 'size=', 'repeat=']),
+    'regress': (bench_regress, ['files=', 'seed=', 'repeat=', 'threshold=', 'save=', 'baseline=']),
+    }
+
+# show command line usage
+def usage(exit_status):
+    msg = 'Usage: benchmark.py BENCHMARK [OPTIONS]\n'
+    msg += 'Run a picasa-directory-sync benchmark.\n\nBenchmarks:\n'
+    msg += 'walker [--files N] [--repeat N] [--dir DIR]   Compare the directory walkers.\n'
+    msg += 'hashing [--files N] [--size BYTES] [--workers N] [--latency SECONDS] [--repeat N]\n'
+    msg += '        Compare serial and threaded loading of file data.\n'
+    msg += 'hashes [--files N] [--size BYTES] [--repeat N] [FILE|DIR ...]\n'
+    msg += '        Compare the speed of the checksum algorithms on large files.\n'
+    msg += 'exif [--repeat N] [--quick] FILE|DIR ...   Time EXIF parsing of the given files and\n'
+    msg += '        fail if a buffered header and bulk values decode them differently than reading\n'
+    msg += '        value by value.\n'
+    msg += 'tiff [--files N] [--size BYTES] [--repeat N]   Time EXIF parsing of large sparse TIFF files.\n'
+    msg += 'memory FILE|DIR ...   Measure the memory used by the tags of the given files.\n'
+    msg += 'fuzz [--mutants N] [--seed N] [--max-time SECONDS] FILE|DIR ...\n'
+    msg += '        Time parsing mutated copies of the given files.\n'
+    msg += 'threads [--threads N] [--repeat N] FILE|DIR ...\n'
+    msg += '        Parse the given files from several threads, failing if a result differs.\n'
+    msg += 'regress [--files N] [--seed N] [--repeat N] [--save FILE] [--baseline FILE] [--threshold PERCENT]\n'
+    msg += '        Time EXIF parsing of generated files in each mode, saving the results or\n'
+    msg += '        failing if they are worse than a saved baseline.\n'
+    print msg
+    sys.exit(exit_status)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        usage(2)
+    func, long_opts = BENCHMARKS[sys.argv[1]]
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "", long_opts)
+    except getopt.GetoptError:
+        usage(2)
+    func(dict(opts), args)
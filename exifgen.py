@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#
+# Deterministic generator of JPEG and TIFF files with EXIF information, for
+# benchmarking and checking EXIF.py without a corpus of real camera files.
+#
+# To generate a corpus call:
+#    files = exifgen.generate_corpus(seed=1, count=100)
+#
+# which returns a list of (name, data) tuples. Each file is described by a
+# Spec, so single files can be generated with e.g.
+#    data = exifgen.generate(exifgen.Spec(make='Canon', thumbnail='jpeg'))
+#
+# MakerNotes are laid out like the cameras in the EXIF.py tables do it:
+# Nikon type 1 and 2 (labeled and unlabeled), Canon, Olympus, Fujifilm and
+# Casio.
+
+import random
+import struct
+
+import EXIF
+
+# struct format of a single value of each field type
+FIELD_FORMATS = {1: 'B', 2: 's', 3: 'H', 4: 'L', 5: 'LL', 6: 'b', 7: 's',
+                 8: 'h', 9: 'l', 10: 'll'}
+
+class Ifd(object):
+    # An IFD to lay out: entries are (tag, field type, values) tuples, where
+    # values is a string for ASCII/Undefined, else a list of numbers (pairs
+    # for ratios). A value may also be a function of the offset its data will
+    # be stored at, returning the data string (used for MakerNotes).
+    # Sub IFDs are written as LONG entries pointing to them.
+    def __init__(self, entries=None, subs=None, next=None):
+        self.entries = entries or []
+        self.subs = subs or {}
+        self.next = next
+        # tag -> (offset of the value field, offset of the data or None)
+        self.slots = {}
+
+def encode_values(endian, field_type, values):
+    if field_type in (2, 7):
+        if field_type == 2:
+            values = values + '\x00'
+        return values, len(values)
+    fmt = endian + FIELD_FORMATS[field_type]
+    if field_type in (5, 10):
+        data = ''.join([struct.pack(fmt, num, den) for num, den in values])
+    else:
+        data = ''.join([struct.pack(fmt, v) for v in values])
+    return data, len(values)
+
+def write_ifd(buf, endian, ifd, base=0):
+    # append the IFD (and its data and sub IFDs) to the bytearray, with all
+    # offsets relative to base. Returns the offset of the IFD.
+    entries = list(ifd.entries) + [(tag, 4, [0]) for tag in ifd.subs]
+    entries.sort(key=lambda entry: entry[0])
+    start = len(buf)
+    buf.extend('\x00' * (2 + 12 * len(entries) + 4))
+    struct.pack_into(endian + 'H', buf, start, len(entries))
+    for i, (tag, field_type, values) in enumerate(entries):
+        pos = start + 2 + 12 * i
+        if callable(values):
+            data = values(base + len(buf))
+            count = len(data)
+        else:
+            data, count = encode_values(endian, field_type, values)
+        struct.pack_into(endian + 'HHL', buf, pos, tag, field_type, count)
+        if len(data) <= 4:
+            buf[pos + 8:pos + 8 + len(data)] = data
+            ifd.slots[tag] = (pos + 8, None)
+        else:
+            data_pos = len(buf)
+            buf.extend(data)
+            if len(buf) % 2:
+                buf.append(0)
+            struct.pack_into(endian + 'L', buf, pos + 8, base + data_pos)
+            ifd.slots[tag] = (pos + 8, data_pos)
+    for tag in sorted(ifd.subs):
+        sub_offset = write_ifd(buf, endian, ifd.subs[tag], base)
+        struct.pack_into(endian + 'L', buf, ifd.slots[tag][0], sub_offset)
+    if ifd.next is not None:
+        next_offset = write_ifd(buf, endian, ifd.next, base)
+        struct.pack_into(endian + 'L', buf, start + 2 + 12 * len(entries), next_offset)
+    return base + start
+
+def ifd_data(endian, ifd, base):
+    buf = bytearray()
+    write_ifd(buf, endian, ifd, base)
+    return str(buf)
+
+def random_entries(rng, tags, count):
+    # entries for count tags picked from an EXIF.py tag table, with values
+    # of a plausible type.
+    entries = []
+    # the Olympus JPEGThumbnail is an offset into the file, not a value
+    tags = dict([(tag, tag_entry) for tag, tag_entry in tags.items() if tag_entry[0] != 'JPEGThumbnail'])
+    for tag in sorted(rng.sample(sorted(tags), min(count, len(tags)))):
+        tag_entry = tags[tag]
+        if len(tag_entry) > 1 and isinstance(tag_entry[1], dict) and tag_entry[1]:
+            value = rng.choice(sorted(tag_entry[1]))
+            if value < 0:
+                field_type = 8
+            elif value > 0xFFFF:
+                field_type = 4
+            else:
+                field_type = 3
+            entries.append((tag, field_type, [value]))
+        elif len(tag_entry) > 1 and tag_entry[1] is EXIF.olympus_special_mode:
+            entries.append((tag, 4, [rng.randint(0, 3), rng.randint(0, 9), rng.randint(0, 4)]))
+        elif len(tag_entry) > 1 and tag_entry[1] is EXIF.nikon_ev_bias:
+            entries.append((tag, 7, chr(rng.choice((252, 253, 254, 0, 2, 3, 4, 9, 250))) + '\x01\x06\x00'))
+        elif len(tag_entry) > 1 and callable(tag_entry[1]):
+            entries.append((tag, 7, 'ASCII\x00\x00\x00text %d' % rng.randint(0, 9999)))
+        else:
+            field_type = rng.choice((2, 3, 4, 5, 7))
+            n = rng.choice((1, 1, 2, 4, 16))
+            if field_type == 2:
+                entries.append((tag, 2, 'value %d' % rng.randint(0, 9999)))
+            elif field_type == 7:
+                entries.append((tag, 7, ''.join([chr(rng.randint(32, 126)) for i in range(n * 4)])))
+            elif field_type == 5:
+                entries.append((tag, 5, [(rng.randint(0, 1000), rng.randint(1, 1000)) for i in range(n)]))
+            else:
+                entries.append((tag, field_type, [rng.randint(0, 255) for i in range(n)]))
+    return entries
+
+# makernote builders: each returns a function of the offset the MakerNote
+# will be stored at, returning the MakerNote data.
+def nikon_type1_makernote(rng, endian, entries):
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_NIKON_OLDER_TAGS, entries))
+    return lambda offset: 'Nikon\x00\x01\x00' + ifd_data(endian, ifd, offset + 8)
+
+def nikon_type2_makernote(rng, endian, entries):
+    # labeled, with its own TIFF header and offsets relative to it
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_NIKON_NEWER_TAGS, entries))
+    tiff_header = (endian == '<' and 'II*\x00' or 'MM\x00*') + struct.pack(endian + 'L', 8)
+    return lambda offset: 'Nikon\x00\x02\x10\x00\x00' + tiff_header + ifd_data(endian, ifd, 8)
+
+def nikon_unlabeled_makernote(rng, endian, entries):
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_NIKON_NEWER_TAGS, entries))
+    return lambda offset: ifd_data(endian, ifd, offset)
+
+def canon_makernote(rng, endian, entries):
+    camera_settings = [0] + [rng.randint(0, 5) for i in range(max(len(EXIF.MAKERNOTE_CANON_TAG_0x001), 40))]
+    shot_info = [0] + [rng.randint(0, 5) for i in range(max(EXIF.MAKERNOTE_CANON_TAG_0x004) + 1)]
+    ifd = Ifd([(0x0001, 3, camera_settings), (0x0004, 3, shot_info)] +
+              random_entries(rng, EXIF.MAKERNOTE_CANON_TAGS, entries))
+    return lambda offset: ifd_data(endian, ifd, offset)
+
+def olympus_makernote(rng, endian, entries):
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_OLYMPUS_TAGS, entries))
+    return lambda offset: 'OLYMP\x00\x01\x00' + ifd_data(endian, ifd, offset + 8)
+
+def casio_makernote(rng, endian, entries):
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_CASIO_TAGS, entries))
+    return lambda offset: ifd_data(endian, ifd, offset)
+
+def fujifilm_makernote(rng, endian, entries):
+    # always Intel byte order, offsets relative to the start of the note
+    ifd = Ifd(random_entries(rng, EXIF.MAKERNOTE_FUJIFILM_TAGS, entries))
+    return lambda offset: 'FUJIFILM' + struct.pack('<L', 12) + ifd_data('<', ifd, 12)
+
+# make -> (value of the Image Make tag, makernote builder)
+MAKERNOTES = {
+    'nikon1': ('NIKON', nikon_type1_makernote),
+    'nikon2': ('NIKON CORPORATION', nikon_type2_makernote),
+    'nikon2-unlabeled': ('NIKON', nikon_unlabeled_makernote),
+    'canon': ('Canon', canon_makernote),
+    'olympus': ('OLYMPUS OPTICAL CO.,LTD', olympus_makernote),
+    'casio': ('CASIO', casio_makernote),
+    'fujifilm': ('FUJIFILM', fujifilm_makernote),
+    }
+
+class Spec(object):
+    # description of a file to generate.
+    def __init__(self, seed=0, format='jpeg', endian='I', make=None,
+                 entries=8, makernote_entries=12, gps=True, thumbnail=None,
+                 thumbnail_size=4096, array_size=0, pre_segments=(),
+                 padding=0, datetime='2010:05:06 07:08:09'):
+        self.seed = seed
+        # 'jpeg' or 'tiff'
+        self.format = format
+        # 'I' (Intel) or 'M' (Motorola) byte order
+        self.endian = endian
+        # None or one of the MAKERNOTES keys
+        self.make = make
+        # number of extra entries in IFD0 and the EXIF IFD, and in the MakerNote
+        self.entries = entries
+        self.makernote_entries = makernote_entries
+        self.gps = gps
+        # None, 'jpeg' or 'tiff' (uncompressed, one strip per 512 bytes)
+        self.thumbnail = thumbnail
+        self.thumbnail_size = thumbnail_size
+        # add an array of this many shorts to the EXIF IFD
+        self.array_size = array_size
+        # JPEG segments (marker, payload) written before the APP1 segment
+        self.pre_segments = pre_segments
+        # bytes of padding between the TIFF header and the first IFD (TIFF)
+        self.padding = padding
+        self.datetime = datetime
+
+    def __repr__(self):
+        return 'Spec(%s)' % ', '.join(['%s=%r' % item for item in sorted(self.__dict__.items())])
+
+def build_tiff(spec, rng):
+    e = spec.endian == 'I' and '<' or '>'
+    make = 'Generic'
+    makernote = None
+    if spec.make:
+        make, builder = MAKERNOTES[spec.make]
+        makernote = builder(rng, e, spec.makernote_entries)
+
+    exif = Ifd([(0x9003, 2, spec.datetime), (0x9004, 2, spec.datetime),
+                (0x829A, 5, [(1, rng.choice((60, 125, 250)))]),
+                (0x9209, 3, [rng.choice((0, 1, 16, 24))])] +
+               random_entries(rng, dict([(t, v) for t, v in EXIF.EXIF_TAGS.items()
+                                         if 0x9000 <= t < 0xA500 and t not in (0x9003, 0x9004, 0x9209, 0x927C, 0x9286, 0xA005)]),
+                              spec.entries))
+    if makernote:
+        exif.entries.append((0x927C, 7, makernote))
+    if spec.array_size:
+        exif.entries.append((0xA420, 3, [rng.randint(0, 65535) for i in range(spec.array_size)]))
+    exif.entries.append((0x9286, 7, 'ASCII\x00\x00\x00generated'))
+
+    ifd0 = Ifd([(0x010F, 2, make), (0x0110, 2, 'Model %d' % spec.seed),
+                (0x0132, 2, spec.datetime), (0x0112, 3, [1]),
+                (0x011A, 5, [(72, 1)]), (0x011B, 5, [(72, 1)]), (0x0128, 3, [2])] +
+               random_entries(rng, dict([(t, v) for t, v in EXIF.EXIF_TAGS.items()
+                                         if 0x0100 <= t < 0x0300 and t not in (0x010F, 0x0110, 0x0132, 0x0112, 0x011A, 0x011B, 0x0128, 0x0111, 0x0117, 0x0201, 0x0202)]),
+                              spec.entries),
+               subs={0x8769: exif})
+    if spec.gps:
+        ifd0.subs[0x8825] = Ifd([(0x0000, 1, [2, 2, 0, 0]), (0x0001, 2, 'N'),
+                                 (0x0002, 5, [(52, 1), (30, 1), (rng.randint(0, 5999), 100)]),
+                                 (0x0003, 2, 'E'), (0x0004, 5, [(13, 1), (24, 1), (rng.randint(0, 5999), 100)]),
+                                 (0x0006, 5, [(rng.randint(0, 5000), 10)])])
+
+    thumbnail = None
+    strips = []
+    if spec.thumbnail == 'jpeg':
+        thumbnail = '\xff\xd8' + ''.join([chr(rng.randint(0, 255)) for i in range(spec.thumbnail_size - 4)]) + '\xff\xd9'
+        ifd0.next = Ifd([(0x0103, 3, [6]), (0x011A, 5, [(72, 1)]), (0x011B, 5, [(72, 1)]), (0x0128, 3, [2]),
+                         (0x0201, 4, [0]), (0x0202, 4, [len(thumbnail)])])
+    elif spec.thumbnail == 'tiff':
+        width = 32
+        height = max(1, spec.thumbnail_size // (width * 3))
+        rows_per_strip = max(1, 512 // (width * 3))
+        for row in range(0, height, rows_per_strip):
+            size = min(rows_per_strip, height - row) * width * 3
+            strips.append(''.join([chr(rng.randint(0, 255)) for i in range(size)]))
+        ifd0.next = Ifd([(0x00FE, 4, [1]), (0x0100, 3, [width]), (0x0101, 3, [height]),
+                         (0x0102, 3, [8, 8, 8]), (0x0103, 3, [1]), (0x0106, 3, [2]),
+                         (0x0111, 4, [0] * len(strips)), (0x0115, 3, [3]),
+                         (0x0116, 3, [rows_per_strip]), (0x0117, 4, [len(s) for s in strips])])
+
+    header = (spec.endian * 2) + struct.pack(e + 'HL', 42, 8 + spec.padding)
+    buf = bytearray(header + '\x00' * spec.padding)
+    write_ifd(buf, e, ifd0)
+
+    # append the thumbnail data and point the thumbnail IFD to it
+    if thumbnail:
+        struct.pack_into(e + 'L', buf, ifd0.next.slots[0x0201][0], len(buf))
+        buf.extend(thumbnail)
+    for i, strip in enumerate(strips):
+        slot, data = ifd0.next.slots[0x0111]
+        struct.pack_into(e + 'L', buf, data is None and slot or data + 4 * i, len(buf))
+        buf.extend(strip)
+    return str(buf)
+
+def generate(spec):
+    # return the data of the file described by spec.
+    rng = random.Random(spec.seed)
+    tiff = build_tiff(spec, rng)
+    if spec.format == 'tiff':
+        # add some image data after the header
+        return tiff + ''.join([chr(rng.randint(0, 255)) for i in range(1024)])
+
+    data = '\xff\xd8'
+    for marker, payload in spec.pre_segments:
+        data += struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+    payload = 'Exif\x00\x00' + tiff
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError('EXIF data too large for an APP1 segment: %d bytes' % len(payload))
+    data += struct.pack('>BBH', 0xFF, 0xE1, len(payload) + 2) + payload
+    # quantization table, frame header, scan header and some "image data"
+    data += '\xff\xdb' + struct.pack('>H', 67) + '\x00' + ''.join([chr(rng.randint(1, 99)) for i in range(64)])
+    data += '\xff\xc0' + struct.pack('>HBHHB', 11, 8, 480, 640, 1) + '\x01\x11\x00'
+    data += '\xff\xda' + struct.pack('>HB', 8, 1) + '\x01\x00\x00\x3f\x00'
+    data += ''.join([chr(rng.randint(0, 254)) for i in range(2048)]) + '\xff\xd9'
+    return data
+
+JFIF_SEGMENT = (0xE0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+ICC_SEGMENT = (0xE2, 'ICC_PROFILE\x00\x01\x01' + '\x00' * 128)
+
+def corpus_specs(seed=0, count=100):
+    # a deterministic mix of file layouts.
+    rng = random.Random(seed)
+    makes = [None] + sorted(MAKERNOTES)
+    specs = []
+    for i in range(count):
+        make = makes[i % len(makes)]
+        fmt = i % 5 == 4 and 'tiff' or 'jpeg'
+        # Nikon type 2 offsets are only right without segments before APP1
+        pre_segments = ()
+        if fmt == 'jpeg' and make != 'nikon2' and i % 3 == 0:
+            pre_segments = (JFIF_SEGMENT,)
+        specs.append(Spec(seed=seed * 100003 + i, format=fmt,
+                          endian=make == 'fujifilm' and 'M' or rng.choice('IM'),
+                          make=make, entries=rng.randint(2, 16),
+                          makernote_entries=rng.randint(4, 24), gps=rng.random() < 0.7,
+                          thumbnail=rng.choice((None, 'jpeg', 'jpeg', 'tiff')),
+                          thumbnail_size=rng.choice((1024, 4096, 8192)),
+                          array_size=rng.choice((0, 0, 64, 600)),
+                          pre_segments=pre_segments))
+    return specs
+
+def generate_corpus(seed=0, count=100):
+    files = []
+    for i, spec in enumerate(corpus_specs(seed, count)):
+        name = '%04d-%s.%s' % (i, spec.make or 'plain', spec.format == 'tiff' and 'tif' or 'jpg')
+        files.append((name, generate(spec)))
+    return files
+
+# write a generated corpus to a directory, to run the EXIF benchmarks on
+if __name__ == '__main__':
+    import os
+    import sys
+    import getopt
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["files=", "seed="])
+    except getopt.GetoptError:
+        args = []
+    if len(args) != 1:
+        print 'Usage: exifgen.py [--files N] [--seed N] DIR'
+        sys.exit(2)
+    opts = dict(opts)
+    if not os.path.isdir(args[0]):
+        os.makedirs(args[0])
+    for name, data in generate_corpus(int(opts.get('--seed', 0)), int(opts.get('--files', 100))):
+        f = open(os.path.join(args[0], name), 'wb')
+        f.write(data)
+        f.close()
@@ -5,13 +5,50 @@ import sys
 import base64
 import fnmatch
 import hashlib
+import json
+import array
+import bisect
+import binascii
+import struct
 import yaml
 import pickle
 import datetime
 import time
 import socket
 import re
+import stat
 import traceback
+import collections
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 import EXIF
 
@@ -62,6 +99,91 @@ class GlobDirectoryWalker:
                 if self.is_file_included(fullname):
                     return fullname
 
+# Entry returned by ScandirWalker: the full path of a file and the stat result
+# taken while walking, so callers do not have to stat the file again.
+FileEntry = collections.namedtuple('FileEntry', 'path stat')
+
+class PatternMatcher(object):
+    # case insensitive fnmatch against a list of patterns, compiled once into
+    # a single regular expression instead of one fnmatch call per pattern.
+    def __init__(self, pattern):
+        self.patterns = [p for p in mustbelist(pattern) if p] if pattern else []
+        if self.patterns:
+            regex = '|'.join(['(?:%s)' % fnmatch.translate(p) for p in self.patterns])
+            self.regex = re.compile(regex, re.IGNORECASE | re.UNICODE)
+        else:
+            self.regex = None
+
+    def __call__(self, name):
+        return self.regex is not None and self.regex.match(name) is not None
+
+class _ListdirEntry(object):
+    # minimal stand-in for os.DirEntry when scandir is not available.
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._lstat = os.lstat(self.path)
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self._lstat.st_mode)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+def scan_directory(directory):
+    if scandir is not None:
+        return scandir(directory)
+    entries = []
+    for name in os.listdir(directory):
+        # like the scandir walker, skip files that vanish or can't be stat'ed
+        try:
+            entries.append(_ListdirEntry(directory, name))
+        except OSError, e:
+            print "Unable to stat %s (%s) - skipping!" % (fs_unic(os.path.join(directory, name)), e)
+    return entries
+
+class ScandirWalker(object):
+    # a forward iterator over the files in a directory tree. The type
+    # information from the directory entries decides what to descend into,
+    # and every file is stat'ed once, with the result kept on the entry.
+    #for entry in ScandirWalker(".", PatternMatcher("*.py")):
+    #    print entry.path, entry.stat.st_size
+    def __init__(self, directory, include_matcher, dir_exclude_matcher=None, stat_directories=False):
+        self.directory = fs_unic(directory)
+        self.include_matcher = include_matcher
+        self.dir_exclude_matcher = dir_exclude_matcher
+        # When enabled, the (path, stat) of every directory walked is
+        # collected in self.directories.
+        self.stat_directories = stat_directories
+        self.directories = []
+
+    def __iter__(self):
+        stack = [self.directory]
+        self.directories = []
+        if self.stat_directories:
+            self.directories.append((self.directory, os.stat(self.directory)))
+        while stack:
+            directory = stack.pop()
+            for entry in scan_directory(directory):
+                fullname = fs_unic(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    if not (self.dir_exclude_matcher and self.dir_exclude_matcher(fullname)):
+                        stack.append(fullname)
+                        if self.stat_directories:
+                            self.directories.append((fullname, entry.stat(follow_symlinks=False)))
+                elif self.include_matcher(fullname):
+                    try:
+                        st = entry.stat()
+                    except OSError, e:
+                        print "Unable to stat %s (%s) - skipping!" % (fullname, e)
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        yield FileEntry(fullname, st)
+
 def request_access(gd_client, domain="default"):
     # Installed applications do not have a pre-registration and so follow
     # directions for unregistered applications
@@ -119,15 +241,202 @@ def get_photo_title(filename, album_path):
         
     return fs_unic(filename)
 
-def md5_for_file(f, block_size=2**20):
+# Hash functions of the plain checksum algorithms. BLAKE2b needs Python 3.6
+# or the pyblake2 module.
+HASH_FUNCTIONS = {'md5': hashlib.md5}
+if blake2b is not None:
+    HASH_FUNCTIONS['blake2b'] = blake2b
+
+# Size of the chunks of tree hashes. Changing it changes all tree checksums.
+TREE_HASH_CHUNK_SIZE = 2**22
+
+def hash_chunk(new_hash, parts, limiter=None, slots=0):
+    # Digest of a chunk given as a list of parts, releasing the limiter slots
+    # held for them.
+    try:
+        h = new_hash()
+        for part in parts:
+            h.update(part)
+        return h.digest()
+    finally:
+        for dummy in range(slots):
+            limiter.release()
+
+class TreeHash(object):
+    # Hash of the data hashing fixed size chunks of it in a pool of threads
+    # shared by all tree hashes (hashlib releases the GIL while hashing),
+    # then hashing the chunk digests and the length of the data. Its
+    # algorithm name is the name of the chunk hash followed by -tree.
+    # With a limiter (the semaphore bounding the blocks read by all threads)
+    # every part kept for the pool holds a slot of it until its chunk is
+    # hashed. Slots are only taken when free: without one the chunk is
+    # hashed as it is read instead, so the caller never waits for them.
+    pool = None
+    pool_lock = threading.Lock()
+    # Number of chunks of one hash waiting for or being hashed at a time.
+    max_pending = 4
+
+    def __init__(self, new_hash, limiter=None):
+        self.new_hash = new_hash
+        self.limiter = limiter
+        self.buffer = []
+        self.buffered = 0
+        self.slots = 0
+        self.chunk_hash = None
+        self.length = 0
+        self.pending = collections.deque()
+        self.digests = []
+        self.result = None
+
+    @classmethod
+    def get_pool(cls):
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = multiprocessing.pool.ThreadPool(default_worker_threads())
+            return cls.pool
+
+    def _hold(self):
+        # Take a limiter slot for one more buffered part, if one is free.
+        if self.limiter is None:
+            return True
+        if self.limiter.acquire(False):
+            self.slots += 1
+            return True
+        return False
+
+    def release(self):
+        # Give back the slots of the buffered parts (of an unfinished hash).
+        for dummy in range(self.slots):
+            self.limiter.release()
+        self.slots = 0
+        self.buffer = []
+
+    def _hash_buffer(self):
+        if self.chunk_hash is not None:
+            digest = self.chunk_hash.digest()
+            self.pending.append(lambda: digest)
+        else:
+            result = self.get_pool().apply_async(hash_chunk, (self.new_hash, self.buffer, self.limiter, self.slots))
+            self.pending.append(result.get)
+        self.buffer = []
+        self.buffered = 0
+        self.slots = 0
+        self.chunk_hash = None
+        while len(self.pending) > self.max_pending:
+            self.digests.append(self.pending.popleft()())
+
+    def update(self, data):
+        self.length += len(data)
+        while data:
+            part = data[:TREE_HASH_CHUNK_SIZE - self.buffered]
+            data = data[len(part):]
+            if self.chunk_hash is None and not self._hold():
+                self.chunk_hash = self.new_hash()
+                for buffered in self.buffer:
+                    self.chunk_hash.update(buffered)
+                self.release()
+            if self.chunk_hash is not None:
+                self.chunk_hash.update(part)
+            else:
+                self.buffer.append(part)
+            self.buffered += len(part)
+            if self.buffered == TREE_HASH_CHUNK_SIZE:
+                self._hash_buffer()
+
+    def hexdigest(self):
+        if self.result is None:
+            if self.buffered:
+                self._hash_buffer()
+            while self.pending:
+                self.digests.append(self.pending.popleft()())
+            h = self.new_hash()
+            for digest in self.digests:
+                h.update(digest)
+            h.update(str(self.length))
+            self.result = h.hexdigest()
+        return self.result
+
+def hash_algorithms():
+    # Names of the available checksum algorithms.
+    return sorted(HASH_FUNCTIONS.keys() + [name + '-tree' for name in HASH_FUNCTIONS])
+
+def unavailable_hash_algorithm(algorithm):
+    return ValueError("Unknown or unavailable hash algorithm %s (available: %s)" % (algorithm, ', '.join(hash_algorithms())))
+
+def new_hash(algorithm, limiter=None):
+    # A hash object (with update and hexdigest) for a checksum algorithm.
+    # The limiter bounds the data buffered by tree hashes.
+    if algorithm.endswith('-tree') and algorithm[:-5] in HASH_FUNCTIONS:
+        return TreeHash(HASH_FUNCTIONS[algorithm[:-5]], limiter)
+    if algorithm in HASH_FUNCTIONS:
+        return HASH_FUNCTIONS[algorithm]()
+    raise unavailable_hash_algorithm(algorithm)
+
+def tagged_checksum(algorithm, digest):
+    # Checksums are stored as "algorithm:hex digest", except MD5 checksums
+    # which are bare hex digests as in state written before algorithms could
+    # be chosen.
+    if algorithm == 'md5':
+        return digest
+    return '%s:%s' % (algorithm, digest)
+
+# Files of at least this size get a sampled checksum: a hash of their size
+# and of SAMPLE_BLOCKS blocks spread evenly from their start to their end,
+# so only a few MB of them are read. Its algorithm is named after the hash
+# with a sampled- prefix.
+SAMPLED_HASH_MIN_SIZE = 100*(2**20)
+SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 2**19
+
+def sampled_algorithm(algorithm):
+    if algorithm.startswith('sampled-'):
+        return algorithm
+    if algorithm.endswith('-tree'):
+        algorithm = algorithm[:-5]
+    return 'sampled-' + algorithm
+
+def is_available_algorithm(algorithm):
+    # Whether checksums of an algorithm, sampled or not, can be computed.
+    if algorithm.startswith('sampled-'):
+        algorithm = algorithm[len('sampled-'):]
+    return algorithm in hash_algorithms()
+
+def file_algorithm(algorithm, file_size):
+    # The algorithm of the checksum of a file of the given size.
+    if file_size >= SAMPLED_HASH_MIN_SIZE:
+        return sampled_algorithm(algorithm)
+    return algorithm
+
+def checksum_algorithm(checksum):
+    if checksum is None:
+        return None
+    if ':' in checksum:
+        return checksum.split(':', 1)[0]
+    return 'md5'
+
+def same_checksum(checksums, checksum):
+    # Whether the checksums of a file (by algorithm) match a checksum.
+    return checksums.get(checksum_algorithm(checksum)) == checksum
+
+def checksum_for_file(f, algorithm='md5', block_size=2**20, limiter=None):
+    # The optional limiter (a semaphore) bounds the number of blocks held in
+    # memory at a time by all threads hashing files.
     f.seek(0)
-    md5 = hashlib.md5()
+    h = new_hash(algorithm, limiter)
     while True:
-        data = f.read(block_size)
+        if limiter:
+            with limiter:
+                data = f.read(block_size)
+                h.update(data)
+        else:
+            data = f.read(block_size)
+            h.update(data)
         if not data:
             break
-        md5.update(data)
-    return md5.hexdigest()
+    return tagged_checksum(algorithm, h.hexdigest())
+
+def md5_for_file(f, block_size=2**20, limiter=None):
+    return checksum_for_file(f, 'md5', block_size, limiter)
 
 def md5_for_string(s):
     md5 = hashlib.md5()
@@ -136,10 +445,661 @@ def md5_for_string(s):
     md5.update(s)
     return md5.hexdigest()
 
-def modification_date(filename):
-    t = os.path.getmtime(filename)
+def modification_date(filename, st=None):
+    t = st.st_mtime if st is not None else os.path.getmtime(filename)
     return datetime.datetime.fromtimestamp(t)
 
+def stat_mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 10**9))
+    return mtime_ns
+
+class FileDataCache(object):
+    # Checksums and capture dates computed by earlier runs, keyed on the
+    # (device, inode) of the file so hard links share one entry. An entry is
+    # only used while the size and mtime of the file are unchanged, so an
+    # unchanged file costs the stat done by the walker and nothing else.
+    # Version 1 caches took the date from Image DateTime only, and version 2
+    # caches did not read the dates of movies; their checksums are kept and
+    # the dates read again. Caches before version 4 had no checksums for
+    # large files, which are read again.
+    VERSION = 4
+
+    def __init__(self, filename, verify=False):
+        self.filename = filename
+        self.verify = verify
+        self.entries = {}
+        self.fresh = set()
+        self.modified = False
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache.get('version') == self.VERSION:
+                    self.entries = cache['entries']
+                elif cache.get('version') == 3:
+                    self.entries = dict([(key, entry) for key, entry in cache['entries'].iteritems()
+                                         if entry[2] is not None])
+                    self.modified = True
+                elif cache.get('version') in (1, 2):
+                    self.entries = dict([(key, (size, mtime_ns, checksum, None))
+                                         for key, (size, mtime_ns, checksum, dt) in cache['entries'].iteritems()
+                                         if checksum is not None])
+                    self.modified = True
+            except Exception, e:
+                print "Ignoring unreadable file cache %s (%s)" % (self.filename, e)
+
+    def lookup(self, st):
+        # Return the (checksum, date) of an unchanged file, with a date of
+        # None if only the checksum is known, or None.
+        key = (st.st_dev, st.st_ino)
+        entry = self.entries.get(key)
+        # When verifying, only trust entries computed during this run (hard
+        # links to a file that was just read).
+        if entry is None or (self.verify and key not in self.fresh):
+            return None
+        size, mtime_ns, checksum, dt = entry
+        if size != st.st_size or mtime_ns != stat_mtime_ns(st):
+            return None
+        self.fresh.add(key)
+        return checksum, dt
+
+    def store(self, st, checksum, dt):
+        key = (st.st_dev, st.st_ino)
+        self.entries[key] = (st.st_size, stat_mtime_ns(st), checksum, dt)
+        self.fresh.add(key)
+        self.modified = True
+
+    def save(self):
+        # Drop entries for files that were not seen during this run.
+        if len(self.fresh) != len(self.entries):
+            self.entries = dict([(key, self.entries[key]) for key in self.fresh])
+            self.modified = True
+        if not self.modified:
+            return
+        try:
+            with open(self.filename, 'wb') as f:
+                pickle.dump({'version': self.VERSION, 'entries': self.entries},
+                            f, pickle.HIGHEST_PROTOCOL)
+            self.modified = False
+        except (IOError, OSError), e:
+            print "Unable to save file cache %s (%s)" % (self.filename, e)
+
+class SyncJournal(object):
+    # Append-only log of the changes made to the sync state of an album
+    # since its last snapshot (the .picasa-sync file), one JSON object per
+    # line, so a change costs a short write instead of dumping the whole
+    # state. Records are written as they are appended, so they survive the
+    # process, and fsync'd in groups to survive the system: once group_size
+    # records or group_seconds have gone by since the last fsync, and on
+    # close.
+    def __init__(self, filename, group_size=32, group_seconds=1.0):
+        self.filename = filename
+        self.group_size = group_size
+        self.group_seconds = group_seconds
+        self.file = None
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def append(self, record):
+        if self.file is None:
+            self.file = open(self.filename, 'ab')
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+        self.pending += 1
+        if self.pending >= self.group_size or time.time() - self.last_commit >= self.group_seconds:
+            self.commit()
+
+    def commit(self):
+        if self.file is not None and self.pending:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.commit()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        # Called once the changes are in a snapshot.
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def read_sync_journal(filename):
+    # The records of a journal. A crash can leave a partly written last
+    # record, which is ignored with anything after it.
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename, 'rb') as f:
+        for line in f:
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('incomplete record')
+                records.append(json.loads(line))
+            except ValueError, e:
+                print "Ignoring the end of %s from record %d (%s)" % (filename, len(records) + 1, e)
+                break
+    return records
+
+def apply_sync_journal(picasa_sync_config, records):
+    # Apply journal records to a sync state: the filename and checksum of a
+    # photo, or the id and fingerprint of the album.
+    for record in records:
+        if record['op'] == 'photo':
+            picasa_sync_config['photos_by_id_map'][str(record['id'])] = [record['filename'], str(record['checksum'])]
+        elif record['op'] == 'album':
+            picasa_sync_config['album_gphoto_id'] = str(record['id'])
+            picasa_sync_config['fingerprint'] = record['fingerprint']
+
+def load_picasa_sync_config(filename):
+    # The state of the last sync of an album directory, or None if it has
+    # not been synchronized: the snapshot, and the changes in its journal.
+    records = read_sync_journal(filename + '-journal')
+    if not os.path.exists(filename) and not records:
+        return None
+    picasa_sync_config = {'photos_by_id_map': {}, 'album_gphoto_id': '', 'fingerprint': None}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            print "opening .picasa-sync"
+            picasa_sync_config = yaml.load(f)
+    apply_sync_journal(picasa_sync_config, records)
+    # Compensate for old bug where filenames were written down in str format instead of unicode
+    photos_by_id_map = picasa_sync_config['photos_by_id_map']
+    for gphoto_id, (filename, checksum) in photos_by_id_map.iteritems():
+        if isinstance(filename, str):
+            print "Changing filename encoding for " + filename
+            photos_by_id_map[gphoto_id] = [fs_unic(filename), checksum]
+    return picasa_sync_config
+
+def write_picasa_sync_config(filename, picasa_sync_config):
+    # Write a snapshot of a sync state. It is written to a new file renamed
+    # over the old one, so a crash leaves either of them complete.
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        yaml.dump(picasa_sync_config, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+class SyncStateStore(object):
+    # The sync state of all albums in one SQLite database, instead of a
+    # .picasa-sync file and journal in each album directory: loading the
+    # state of an album is an indexed lookup, the state can be queried
+    # across albums, and the album directories may be read-only (but for
+    # the file cache, which is skipped if it cannot be written). Photos are
+    # indexed by gphoto id, path, checksum and album. The database is in WAL
+    # mode, and changes are committed in batches, like the journal groups:
+    # once batch_size changes or batch_seconds have gone by since the last
+    # commit, at the end of each album, and on close.
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS albums (directory TEXT PRIMARY KEY, album_gphoto_id TEXT, fingerprint TEXT)",
+              "CREATE INDEX IF NOT EXISTS albums_gphoto_id ON albums (album_gphoto_id)",
+              "CREATE TABLE IF NOT EXISTS photos (directory TEXT, gphoto_id TEXT, filename TEXT, checksum TEXT, "
+              "PRIMARY KEY (directory, gphoto_id))",
+              "CREATE INDEX IF NOT EXISTS photos_gphoto_id ON photos (gphoto_id)",
+              "CREATE INDEX IF NOT EXISTS photos_path ON photos (directory, filename)",
+              "CREATE INDEX IF NOT EXISTS photos_checksum ON photos (checksum)"]
+
+    def __init__(self, filename, batch_size=32, batch_seconds=1.0):
+        if sqlite3 is None:
+            raise ValueError("A state database needs the sqlite3 module")
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.pending = 0
+        self.last_commit = time.time()
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def _key(self, directory):
+        return fs_unic(os.path.abspath(directory))
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.batch_size or time.time() - self.last_commit >= self.batch_seconds:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def directories(self):
+        return set([row[0] for row in self.connection.execute("SELECT directory FROM albums")])
+
+    def load_album(self, directory):
+        # The sync state of an album directory, like load_picasa_sync_config.
+        directory = self._key(directory)
+        row = self.connection.execute("SELECT album_gphoto_id, fingerprint FROM albums WHERE directory = ?",
+                                      (directory,)).fetchone()
+        if row is None:
+            return None
+        photos_by_id_map = {}
+        for gphoto_id, filename, checksum in self.connection.execute(
+                "SELECT gphoto_id, filename, checksum FROM photos WHERE directory = ?", (directory,)):
+            photos_by_id_map[str(gphoto_id)] = [filename, str(checksum)]
+        return {'photos_by_id_map': photos_by_id_map, 'album_gphoto_id': str(row[0] or ''),
+                'fingerprint': json.loads(row[1]) if row[1] else None}
+
+    def photos(self, directories):
+        # (directory, gphoto id, checksum) of the synced photos of some
+        # album directories.
+        directories = dict([(self._key(directory), directory) for directory in directories])
+        for directory, gphoto_id, checksum in self.connection.execute(
+                "SELECT directory, gphoto_id, checksum FROM photos"):
+            if directory in directories:
+                yield directories[directory], str(gphoto_id), str(checksum)
+
+    def album_gphoto_id(self, directory):
+        row = self.connection.execute("SELECT album_gphoto_id FROM albums WHERE directory = ?",
+                                      (self._key(directory),)).fetchone()
+        return row and str(row[0] or '')
+
+    def photo_filename(self, directory, gphoto_id):
+        row = self.connection.execute("SELECT filename FROM photos WHERE directory = ? AND gphoto_id = ?",
+                                      (self._key(directory), gphoto_id)).fetchone()
+        return row and row[0]
+
+    def put_photo(self, directory, gphoto_id, filename, checksum):
+        self.connection.execute("INSERT OR REPLACE INTO photos (directory, gphoto_id, filename, checksum) VALUES (?, ?, ?, ?)",
+                                (self._key(directory), gphoto_id, fs_unic(filename), checksum))
+        self._changed()
+
+    def put_album(self, directory, album_gphoto_id, fingerprint):
+        self.connection.execute("INSERT OR REPLACE INTO albums (directory, album_gphoto_id, fingerprint) VALUES (?, ?, ?)",
+                                (self._key(directory), album_gphoto_id,
+                                 json.dumps(fingerprint, sort_keys=True) if fingerprint else None))
+        self._changed()
+
+    def save_album(self, directory, picasa_sync_config):
+        # Replace the whole sync state of an album directory, and commit.
+        key = self._key(directory)
+        self.connection.execute("DELETE FROM photos WHERE directory = ?", (key,))
+        self.connection.executemany("INSERT INTO photos (directory, gphoto_id, filename, checksum) VALUES (?, ?, ?, ?)",
+                                    [(key, gphoto_id, fs_unic(filename), checksum) for gphoto_id, (filename, checksum)
+                                     in picasa_sync_config['photos_by_id_map'].iteritems()])
+        self.put_album(directory, picasa_sync_config['album_gphoto_id'], picasa_sync_config.get('fingerprint'))
+        self.commit()
+
+    def import_directories(self, directories, replace=False):
+        # Import the .picasa-sync files (and journals) of album directories
+        # that are not in the database yet, or of all of them if replace.
+        known = self.directories()
+        imported = 0
+        for directory in directories:
+            if not replace and self._key(directory) in known:
+                continue
+            picasa_sync_config = load_picasa_sync_config(os.path.join(directory, '.picasa-sync'))
+            if picasa_sync_config:
+                self.save_album(directory, picasa_sync_config)
+                imported += 1
+        if imported:
+            print "Imported the sync state of %d albums into %s" % (imported, self.filename)
+        return imported
+
+    def export_directories(self, directories):
+        # Write the sync state of album directories back to .picasa-sync
+        # files, so they can be synced without the database.
+        exported = 0
+        for directory in directories:
+            picasa_sync_config = self.load_album(directory)
+            if picasa_sync_config:
+                write_picasa_sync_config(os.path.join(directory, '.picasa-sync'), picasa_sync_config)
+                if os.path.exists(os.path.join(directory, '.picasa-sync-journal')):
+                    os.remove(os.path.join(directory, '.picasa-sync-journal'))
+                exported += 1
+        print "Exported the sync state of %d albums from %s" % (exported, self.filename)
+        return exported
+
+def checksum_key(checksum):
+    # 16 byte key of a checksum: the digest of MD5 checksums, the MD5 of
+    # other ones.
+    if len(checksum) == 32 and ':' not in checksum:
+        return binascii.unhexlify(checksum)
+    return hashlib.md5(checksum).digest()
+
+class _SortedKeys(object):
+    # The keys of a ChecksumIndex as a sequence, for bisect.
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys) // 16
+
+    def __getitem__(self, i):
+        return self.keys[16 * i:16 * i + 16]
+
+class ChecksumIndex(object):
+    # Index from checksums to (album number, gphoto id) of the photos having
+    # them: the sorted checksum keys concatenated in a string, searched by
+    # bisection, an array of the album numbers and the photo ids packed as
+    # 64 bit integers in the same order, so each photo takes at most 32
+    # bytes. Photo ids that are not 64 bit numbers are not indexed. The
+    # algorithms of the indexed checksums are kept in self.algorithms.
+    PHOTO_ID = struct.Struct('<Q')
+
+    def __init__(self, photos):
+        rows = []
+        self.algorithms = set()
+        for checksum, album, gphoto_id in photos:
+            try:
+                rows.append((checksum_key(checksum), album, self.PHOTO_ID.pack(int(gphoto_id))))
+            except (ValueError, TypeError, struct.error):
+                continue
+            self.algorithms.add(checksum_algorithm(checksum))
+        rows.sort()
+        self.keys = _SortedKeys(''.join([row[0] for row in rows]))
+        self.albums = array.array('L', [row[1] for row in rows])
+        self.photos = ''.join([row[2] for row in rows])
+
+    def __len__(self):
+        return len(self.albums)
+
+    def lookup(self, checksum):
+        # The (album number, gphoto id) of the photos with a checksum.
+        key = checksum_key(checksum)
+        i = bisect.bisect_left(self.keys, key)
+        photos = []
+        while i < len(self.albums) and self.keys[i] == key:
+            photos.append((self.albums[i], str(self.PHOTO_ID.unpack_from(self.photos, 8 * i)[0])))
+            i += 1
+        return photos
+
+class Library(object):
+    # The synced photos of all albums, so photos moved to another album are
+    # moved online instead of being uploaded again. Deleting photos is
+    # deferred until all albums have been synced, since an album synced
+    # later may take them. The state files are parsed once: their filenames
+    # are kept for find_moved_photo, and the states are handed to the albums
+    # by take_state.
+    def __init__(self, directories, store=None):
+        self.directories = []
+        self.album_ids = []
+        self.store = store
+        self.states = {}
+        self.synced_filenames = []
+        self.deferred_deletions = {}
+        self.moved = set()
+        # Indexed photos that could not be fetched, e.g. deleted online.
+        self.missing = set()
+        self.bytes_saved = 0
+        def stored_photos():
+            albums = {}
+            for directory in directories:
+                album_gphoto_id = store.album_gphoto_id(directory)
+                if album_gphoto_id is not None:
+                    albums[directory] = len(self.directories)
+                    self.directories.append(directory)
+                    self.album_ids.append(album_gphoto_id)
+            for directory, gphoto_id, checksum in store.photos(albums):
+                yield checksum, albums[directory], gphoto_id
+        def photos():
+            for directory in directories:
+                config = load_picasa_sync_config(os.path.join(directory, '.picasa-sync'))
+                if not config:
+                    continue
+                self.directories.append(directory)
+                self.album_ids.append(config['album_gphoto_id'])
+                self.states[directory] = config
+                self.synced_filenames.append(dict([(gphoto_id, filename) for gphoto_id, (filename, checksum)
+                                                   in config['photos_by_id_map'].iteritems()]))
+                album = len(self.directories) - 1
+                for gphoto_id, (filename, checksum) in config['photos_by_id_map'].iteritems():
+                    yield checksum, album, gphoto_id
+        self.index = ChecksumIndex(stored_photos() if store else photos())
+        print "Indexed %d photos/videos of %d albums" % (len(self.index), len(self.directories))
+
+    def take_state(self, directory):
+        # The sync state of an album directory parsed for the index, or None.
+        return self.states.pop(directory, None)
+
+    def _synced_filename(self, album, gphoto_id):
+        if self.store:
+            return self.store.photo_filename(self.directories[album], gphoto_id)
+        return self.synced_filenames[album].get(gphoto_id)
+
+    def find_moved_photo(self, checksums, album_gphoto_id):
+        # The (album gphoto id, gphoto id) of a photo in another album whose
+        # file has one of the checksums and no longer exists, or None.
+        for checksum in checksums:
+            for album, gphoto_id in self.index.lookup(checksum):
+                if self.album_ids[album] == album_gphoto_id or gphoto_id in self.moved or gphoto_id in self.missing:
+                    continue
+                if gphoto_id in self.deferred_deletions:
+                    return self.album_ids[album], gphoto_id
+                filename = self._synced_filename(album, gphoto_id)
+                if filename and not os.path.exists(filename):
+                    return self.album_ids[album], gphoto_id
+        return None
+
+    def move_photo(self, ps_client, checksums, album_gphoto_id, filename, title):
+        # Move a photo of another album whose file has one of the checksums
+        # and no longer exists to an album, with a new title. Returns the
+        # moved photo, or None if the file has to be uploaded.
+        while True:
+            moved_photo = self.find_moved_photo(checksums, album_gphoto_id)
+            if moved_photo is None:
+                return None
+            from_album_gphoto_id, gphoto_id = moved_photo
+            photo = self.deferred_deletions.get(gphoto_id)
+            if photo is not None:
+                break
+            try:
+                photo = ps_client.GetEntry('/data/entry/api/user/default/albumid/%s/photoid/%s' % (from_album_gphoto_id, gphoto_id))
+                break
+            except gdata.photos.service.GooglePhotosException, e:
+                if "Token invalid" in str(e):
+                    raise
+                print "Unable to get photo/video %s of album %s (%s) - not moving it" % (gphoto_id, from_album_gphoto_id, e)
+                self.missing.add(gphoto_id)
+        print u"Moving photo/video %s to %s" % (photo.title.text, filename)
+        photo.albumid.text = album_gphoto_id
+        photo.title.text = title
+        photo = ps_client.UpdatePhotoMetadata(photo)
+        self.deferred_deletions.pop(gphoto_id, None)
+        self.moved.add(gphoto_id)
+        self.bytes_saved += os.path.getsize(filename)
+        return photo
+
+    def defer_deletion(self, photo):
+        self.deferred_deletions[photo.gphoto_id.text] = photo
+
+    def delete_deferred(self, ps_client):
+        for gphoto_id, photo in self.deferred_deletions.items():
+            print "Deleting photo/video %s" % photo.title.text
+            ps_client.Delete(photo)
+            del self.deferred_deletions[gphoto_id]
+        if self.moved:
+            print "Moved %d photos/videos between albums instead of uploading them (%.1f MB saved)" % (
+                len(self.moved), self.bytes_saved / 1024.0 / 1024.0)
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def default_worker_threads():
+    # Reading files is mostly waiting for the disk or network, so use more
+    # threads than CPUs.
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return max(2, min(16, 2 * cpus))
+
+class HeaderFile(object):
+    # Read-only file object over the leading bytes of a file, so the EXIF
+    # header can be parsed from memory. Reads going past the buffer into the
+    # rest of the file set overrun, since their result is incomplete.
+    def __init__(self, data, file_size):
+        self.data = data
+        self.file_size = file_size
+        self.pos = 0
+        self.overrun = False
+
+    def read(self, size=-1):
+        if size < 0:
+            end = self.file_size
+        else:
+            end = min(self.pos + size, self.file_size)
+        if end > len(self.data):
+            self.overrun = True
+        data = self.data[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.file_size
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+def parse_file_date(file, header, file_size):
+    # Parse the capture date from the EXIF header (or the movie header) of
+    # an open file, given its first bytes. Only the date tags are decoded.
+    # Returns the date and the number of bytes read beyond the header.
+    header_file = HeaderFile(header, file_size)
+    tags = EXIF.process_file(header_file, tags=EXIF.DATE_TAGS, preferred=True, details=False)
+    bytes_read = 0
+    if header_file.overrun:
+        # TIFF based files can point far beyond the header, and movies can
+        # have their header after the movie data, so parse the file itself
+        # (EXIF maps large files instead of reading them).
+        position = file.tell()
+        file.seek(0)
+        counting_file = EXIF.CountingFile(file)
+        report = EXIF.ParseReport()
+        tags = EXIF.process_file(counting_file, tags=EXIF.DATE_TAGS, preferred=True, details=False, report=report)
+        bytes_read = counting_file.bytes_read + report.bytes_mapped
+        file.seek(position)
+    return date_from_tags(tags), bytes_read
+
+def date_from_tags(tags):
+    # The most accurate date in the EXIF tags, or None.
+    for tag in EXIF.DATE_TAGS:
+        if tag in tags:
+            dt = EXIF.parse_datetime(tags[tag])
+            if dt:
+                return dt
+    return None
+
+def load_file_date(filename, file_size, limiter=None):
+    # Read only the capture date of a file whose checksum is known, returning
+    # the date (or None) and the number of bytes read.
+    with open(filename, 'rb') as file:
+        if limiter:
+            with limiter:
+                header = file.read(2**16)
+        else:
+            header = file.read(2**16)
+        dt, bytes_read = parse_file_date(file, header, file_size)
+        return dt, len(header) + bytes_read
+
+def load_file_data(filename, file_size, limiter=None, block_size=2**20, parse_date=True, algorithms=('md5',)):
+    # Read the capture date (None if there is no EXIF date or parse_date is
+    # false), checksums (a dict of the checksum for each of the algorithms,
+    # sampled for large files) and number of bytes read of a file. The file
+    # is read once, from start to end: the first block is both hashed and
+    # used to parse the EXIF header. Called from worker threads.
+    hash_file = file_size < SAMPLED_HASH_MIN_SIZE
+    if hash_file:
+        hashes = [(algorithm, new_hash(algorithm, limiter)) for algorithm in algorithms]
+    else:
+        algorithms = sorted(set(map(sampled_algorithm, algorithms)))
+        hashes = [(algorithm, HASH_FUNCTIONS[algorithm[8:]]()) for algorithm in algorithms]
+        for algorithm, h in hashes:
+            h.update(str(file_size))
+    def update(data):
+        for algorithm, h in hashes:
+            h.update(data)
+    try:
+        with open(filename, 'rb') as file:
+            # The header of large files is their first sample (it holds the APP1
+            # segment, at most 64 KB).
+            header_size = block_size if hash_file else SAMPLE_BLOCK_SIZE
+            if limiter:
+                with limiter:
+                    header = file.read(header_size)
+                    update(header)
+            else:
+                header = file.read(header_size)
+                update(header)
+            bytes_read = len(header)
+
+            dt = None
+            if parse_date:
+                dt, date_bytes_read = parse_file_date(file, header, file_size)
+                bytes_read += date_bytes_read
+            del header
+
+            if hash_file:
+                while True:
+                    if limiter:
+                        with limiter:
+                            data = file.read(block_size)
+                            update(data)
+                    else:
+                        data = file.read(block_size)
+                        update(data)
+                    bytes_read += len(data)
+                    if not data:
+                        break
+            else:
+                for i in range(1, SAMPLE_BLOCKS):
+                    file.seek((file_size - SAMPLE_BLOCK_SIZE) * i // (SAMPLE_BLOCKS - 1))
+                    if limiter:
+                        with limiter:
+                            data = file.read(SAMPLE_BLOCK_SIZE)
+                            update(data)
+                    else:
+                        data = file.read(SAMPLE_BLOCK_SIZE)
+                        update(data)
+                    bytes_read += len(data)
+            checksums = dict([(algorithm, tagged_checksum(algorithm, h.hexdigest())) for algorithm, h in hashes])
+    finally:
+        # Tree hashes of a file that could not be read keep limiter slots.
+        for algorithm, h in hashes:
+            if isinstance(h, TreeHash):
+                h.release()
+    return dt, checksums, bytes_read
+
+def album_fingerprint(directory, entries, directories):
+    # Cheap summary of an album tree that changes whenever a file is added,
+    # removed, renamed, resized or modified: the path, size and mtime of the
+    # included files and the mtimes of the subdirectories, plus the number
+    # and total size of the files. The mtime of the album directory itself
+    # is left out, since our own state files in it change it. Only stat
+    # results are used.
+    md5 = hashlib.md5()
+    for path, st in sorted(directories):
+        if path[len(directory):]:
+            md5.update(('%s\0%d\n' % (path[len(directory):], stat_mtime_ns(st))).encode('utf-8'))
+    for entry in sorted(entries, key=lambda entry: entry.path):
+        md5.update(('%s\0%d\0%d\n' % (entry.path[len(directory):], entry.stat.st_size,
+                                     stat_mtime_ns(entry.stat))).encode('utf-8'))
+    return {'tree': md5.hexdigest(),
+            'files': len(entries),
+            'bytes': sum([entry.stat.st_size for entry in entries])}
+
 def get_content_type_from_extension(extension):
     extension_to_content_type = {'jpg': 'image/jpeg',
                                  'jpeg': 'image/jpeg',
@@ -151,90 +1111,312 @@ def get_content_type_from_extension(extension):
     return extension_to_content_type.get(extension)
     
 class Album(object):
-    def __init__(self, directory, title, include_files, exclude_dirs):
+    def __init__(self, directory, title, include_matcher, exclude_matcher, verify_checksums=False,
+                 worker_threads=None, max_inflight_blocks=None, exif_backend='thread', hash_algorithm='md5',
+                 library=None, journal_group_size=32, store=None, exif_pool=None):
         self.directory = directory
         self.title = title
-        self.include_files = include_files
-        self.exclude_dirs = exclude_dirs
+        self.include_matcher = include_matcher
+        self.exclude_matcher = exclude_matcher
+        self.verify_checksums = verify_checksums
+        self.worker_threads = worker_threads or default_worker_threads()
+        self.max_inflight_blocks = max_inflight_blocks or 2 * self.worker_threads
+        self.queue_size = 4 * self.worker_threads
+        self.exif_backend = exif_backend
+        self.exif_pool = exif_pool
+        if hash_algorithm not in hash_algorithms():
+            raise unavailable_hash_algorithm(hash_algorithm)
+        self.hash_algorithm = hash_algorithm
+        self.library = library
+        self.store = store
         self.picasa_sync_config = None
         self.picasa_sync_config_filename = os.path.join(directory, '.picasa-sync')
+        self.journal = SyncJournal(os.path.join(directory, '.picasa-sync-journal'), journal_group_size)
+        self.file_data_cache_filename = os.path.join(directory, '.picasa-sync-cache')
         self.synced_photos_by_id_map = {}
         self.synced_album_gphoto_id = ""
+        self.synced_fingerprint = None
+        self.local_fingerprint = None
+        self.walked = None
+        self.deferred_count = 0
 
-        # If the directory has been synchronized before it will contain a .picasa-sync file with the state from the last sync.
-        if os.path.exists(self.picasa_sync_config_filename):
-            with open(self.picasa_sync_config_filename) as f:
-                print "opening .picasa-sync"
-                picasa_sync_config = yaml.load(f)
-                self.synced_photos_by_id_map = picasa_sync_config['photos_by_id_map']
-                
-                # Compensate for old bug where filenames were written down in str format instead of unicode
-                for gphoto_id, (filename, checksum) in self.synced_photos_by_id_map.iteritems():
-                    if isinstance(filename, str):
-                        print "Changing filename encoding for " + filename
-                        self.synced_photos_by_id_map[gphoto_id] = [fs_unic(filename), checksum]
-                        
-                self.synced_album_gphoto_id = picasa_sync_config['album_gphoto_id']
-                print "GPhoto ID: %s" % self.synced_album_gphoto_id
+        # If the directory has been synchronized before the state database or
+        # its .picasa-sync file holds the state from the last sync.
+        if store:
+            picasa_sync_config = store.load_album(directory)
+        else:
+            picasa_sync_config = library and library.take_state(directory)
+            if not picasa_sync_config:
+                picasa_sync_config = load_picasa_sync_config(self.picasa_sync_config_filename)
+        if picasa_sync_config:
+            self.synced_photos_by_id_map = picasa_sync_config['photos_by_id_map']
+            self.synced_album_gphoto_id = picasa_sync_config['album_gphoto_id']
+            self.synced_fingerprint = picasa_sync_config.get('fingerprint')
+            print "GPhoto ID: %s" % self.synced_album_gphoto_id
+            # Compact the changes left in the journal by an interrupted sync.
+            if not store and os.path.exists(self.journal.filename):
+                self._save_picasa_sync_config()
 
         self.synced_photos_by_filename_map = dict([(filename, gphoto_id) for gphoto_id, (filename, checksum) in self.synced_photos_by_id_map.iteritems()])
         self.album_datetime = datetime.datetime.now()
         self.file_data_list = []
         self.online_album = None
+        self.bytes_read = 0
+        self.files_read = 0
+        self.first_upload_time = None
             
-    def _load_file_data_list(self):
-        self.album_datetime = datetime.datetime.max
-        file_data_list = []
-        movies = set()
-        
-        filenames = [filename for filename in GlobDirectoryWalker(self.directory, self.include_files, self.exclude_dirs)]
-        for filename in filenames:
-            basename, extension = os.path.splitext(filename)
-            
-            with open(filename) as file:
-                tags = EXIF.process_file(file, stop_tag='Image DateTime', details=False)
-                if 'Image DateTime' in tags:
-                    dt = datetime.datetime.strptime(str(tags['Image DateTime']), "%Y:%m:%d %H:%M:%S")
-                else:
-                    dt = modification_date(filename)
-                
-                # Set album time to the time of the oldest photo in the album
-                if dt < self.album_datetime:
-                    self.album_datetime = dt
+    def _walk(self):
+        # The included files of the album and its fingerprint. The result of
+        # is_unchanged is kept in self.walked for update_online_album.
+        walker = ScandirWalker(self.directory, self.include_matcher, self.exclude_matcher, stat_directories=True)
+        entries = list(walker)
+        return entries, album_fingerprint(self.directory, entries, walker.directories)
 
-                print "%s: %s" % (filename, dt)
+    def is_unchanged(self):
+        # True when neither the local tree nor the online album has changed
+        # since the last completed sync, judged from stat results and the
+        # album entry already fetched with the user feed. Content changes that
+        # keep size and mtime only show in the checksums, so verify_checksums
+        # always syncs.
+        if self.verify_checksums or not self.online_album or not self.synced_fingerprint:
+            return False
+        online = self.synced_fingerprint.get('online')
+        if online != {'updated': self.online_album.updated.text, 'numphotos': self.online_album.numphotos.text}:
+            return False
+        self.walked = self._walk()
+        entries, fingerprint = self.walked
+        return all([self.synced_fingerprint.get(key) == value for key, value in fingerprint.iteritems()])
 
-                file_size = os.path.getsize(filename)
-                if file_size < 100*(2**20):    
-                    checksum = md5_for_file(file)
-                else:
-                    checksum = md5_for_string(filename+unicode(file_size))
-                file_data = {'filename': filename, 'datetime': dt, 'checksum': checksum}
-                file_data_list.append(file_data)
-                
-                # Maintain a set of all movies to filter out thumbnail images below.
-                if extension.lower() in ('.mov', '.mpg', '.mpeg'):
-                    movies.add(basename)
-        
-        # Assume that thUmbnail images have the same filename as the movie, but an image extension.
-        self.file_data_list = []
-        for file_data in file_data_list:
-            basename, extension = os.path.splitext(file_data['filename'])
+    def _refresh_online_album(self, ps_client):
+        self.online_album = ps_client.GetEntry('/data/entry/api/user/default/albumid/%s' % self.synced_album_gphoto_id)
+
+    def _update_fingerprint(self, ps_client):
+        # Fetch the album entry again, since uploads change its update time
+        # and photo count.
+        self._refresh_online_album(ps_client)
+        # The fingerprint is the one taken before the sync, so files changed
+        # during it are synced by the next run.
+        fingerprint = dict(self.local_fingerprint)
+        fingerprint['online'] = {'updated': self.online_album.updated.text, 'numphotos': self.online_album.numphotos.text}
+        self.synced_fingerprint = fingerprint
+        self._save_picasa_sync_config()
+
+    def _filter_movie_thumbnails(self, entries):
+        # Assume that thumbnail images have the same filename as the movie, but an image extension.
+        movies = set()
+        for entry in entries:
+            basename, extension = os.path.splitext(entry.path)
+            if extension.lower() in ('.mov', '.mpg', '.mpeg'):
+                movies.add(basename)
+
+        filtered_entries = []
+        for entry in entries:
+            basename, extension = os.path.splitext(entry.path)
             if extension.lower() not in ('.bmp', '.jpeg', '.jpg', '.gif', '.png') or basename not in movies:
-                self.file_data_list.append(file_data)
+                filtered_entries.append(entry)
             else:
-                print "Image assumed to be a movie thumbnail: " + file_data['filename'] + " - skipping!"
+                print "Image assumed to be a movie thumbnail: " + entry.path + " - skipping!"
+        return filtered_entries
+
+    def _synced_checksum(self, filename):
+        gphoto_id = self.synced_photos_by_filename_map.get(filename)
+        if gphoto_id is None:
+            return None
+        return self.synced_photos_by_id_map[gphoto_id][1]
+
+    def _checksum_algorithms(self, filenames):
+        # The algorithms of the checksums synced for the files.
+        return set([checksum_algorithm(self._synced_checksum(filename)) for filename in filenames]) - set([None])
+
+    def _has_checksum(self, file_data, checksum):
+        # Whether a file has a synced checksum. Large files are trusted to be
+        # unchanged when their sampled checksum matches, or the name+size
+        # checksum of older versions.
+        if same_checksum(file_data['checksums'], checksum):
+            return True
+        return checksum == file_data.get('legacy_checksum')
+
+    def _iter_file_data(self, entries):
+        # Generate the file data of the entries in walk order, so uploads
+        # start before all files have been read (they used to be uploaded in
+        # order of capture date, once all of them were read). Files missing
+        # from the cache are read by worker threads, which run at most
+        # queue_size files ahead of the consumer. Hard links are read once.
+        # With the process EXIF backend the dates are parsed by a pool of
+        # processes, and the threads only checksum the files.
+        self.bytes_read = 0
+        self.files_read = 0
+        file_data_cache = FileDataCache(self.file_data_cache_filename, verify=self.verify_checksums)
+        limiter = threading.BoundedSemaphore(self.max_inflight_blocks)
+
+        same_files = collections.OrderedDict()
+        for entry in entries:
+            same_files.setdefault((entry.stat.st_dev, entry.stat.st_ino), []).append(entry)
+
+        # Files are hashed with the configured algorithm, and with those of
+        # the checksums they are compared with: the ones synced for them, or
+        # for new files those of the synced files that may have been renamed
+        # to them. A cached checksum is used as long as it has the algorithm
+        # of these, so changing the algorithm only rehashes files that have
+        # to be read anyway; their synced checksums are then replaced. Large
+        # files are compared by sampled checksums. Checksums of algorithms
+        # that are not available here (BLAKE2b synced on another host) cannot
+        # be compared, so their files count as changed. With a library, new
+        # files are also hashed with the algorithms of the other albums, so
+        # photos moved from them are found after an algorithm change.
+        local_filenames = set([entry.path for entry in entries])
+        renamed_algorithms = self._checksum_algorithms([filename for filename in self.synced_photos_by_filename_map
+                                                        if filename not in local_filenames])
+        library_algorithms = set()
+        if self.library:
+            library_algorithms = set([algorithm[len('sampled-'):] if algorithm.startswith('sampled-') else algorithm
+                                      for algorithm in self.library.index.algorithms])
+        unavailable_algorithms = set()
+        files = []
+        for same in same_files.itervalues():
+            synced_algorithms = self._checksum_algorithms([entry.path for entry in same])
+            compared_algorithms = synced_algorithms or renamed_algorithms
+            compared_algorithms = set([file_algorithm(algorithm, same[0].stat.st_size) for algorithm in compared_algorithms])
+            unavailable_algorithms.update([algorithm for algorithm in compared_algorithms if not is_available_algorithm(algorithm)])
+            if not synced_algorithms:
+                compared_algorithms.update([file_algorithm(algorithm, same[0].stat.st_size) for algorithm in library_algorithms])
+            compared_algorithms = set([algorithm for algorithm in compared_algorithms if is_available_algorithm(algorithm)])
+            algorithms = [self.hash_algorithm] + sorted(compared_algorithms - set([self.hash_algorithm]))
+            cached = file_data_cache.lookup(same[0].stat)
+            if cached and cached[0] is not None and not compared_algorithms <= set([checksum_algorithm(cached[0])]):
+                cached = None
+            files.append((same[0], cached, algorithms))
+        if unavailable_algorithms:
+            print "Unable to compare %s checksums - their files are treated as changed" % ', '.join(sorted(unavailable_algorithms))
+        # The EXIF processes must be forked before any thread is started:
+        # main makes them once for all albums, and without them they are made
+        # here, before the threads of this album.
+        processes = self.exif_backend == 'process'
+        dates = None
+        dates_pool = None
+        if processes:
+            if self.exif_pool is None:
+                dates_pool = multiprocessing.Pool(self.worker_threads)
+            dates = EXIF.process_files([item[0].path for item in files if not item[1] or item[1][1] is None],
+                                       pool=self.exif_pool or dates_pool,
+                                       tags=EXIF.DATE_TAGS, preferred=True, details=False)
+
+        def load(item):
+            entry, cached, algorithms = item
+            if cached and cached[1] is None:
+                checksums = cached[0] and {checksum_algorithm(cached[0]): cached[0]}
+                if processes:
+                    return None, (None, checksums, 0)
+                dt, bytes_read = load_file_date(entry.path, entry.stat.st_size, limiter)
+                return None, (dt, checksums, bytes_read)
+            if cached:
+                return cached, None
+            dt, checksums, bytes_read = load_file_data(entry.path, entry.stat.st_size, limiter,
+                                                       parse_date=not processes, algorithms=algorithms)
+            return None, (dt, checksums, bytes_read)
+
+        window = threading.Semaphore(self.queue_size)
+        closed = []
+        def window_iter(items):
+            for item in items:
+                window.acquire()
+                if closed:
+                    return
+                yield item
+
+        pool = None
+        if self.worker_threads > 1 and len(same_files) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(self.worker_threads, len(same_files)))
+            results = pool.imap(load, window_iter(files))
+        else:
+            results = itertools.imap(load, files)
+        try:
+            for same_file, (cached, loaded) in itertools.izip(same_files.itervalues(), results):
+                if pool:
+                    window.release()
+                entry = same_file[0]
+                if cached:
+                    checksum, dt = cached
+                    checksums = {checksum_algorithm(checksum): checksum}
+                else:
+                    dt, checksums, bytes_read = loaded
+                    checksum = None
+                    if checksums:
+                        checksum = checksums.get(file_algorithm(self.hash_algorithm, entry.stat.st_size),
+                                                 checksums.values()[0])
+                    self.bytes_read += bytes_read
+                    self.files_read += 1
+                    if processes:
+                        result = dates.next()
+                        if result.error:
+                            print "Unable to read the EXIF date of %s (%s)" % (result.path, result.error)
+                        dt = date_from_tags(result.tags)
+                    if dt is None:
+                        dt = modification_date(entry.path, entry.stat)
+                    file_data_cache.store(entry.stat, checksum, dt)
+
+                for entry in same_file:
+                    filename = entry.path
+                    file_data = {'filename': filename, 'datetime': dt, 'checksum': checksum, 'checksums': checksums}
+                    if entry.stat.st_size >= SAMPLED_HASH_MIN_SIZE:
+                        # Older versions identified large files by a hash of
+                        # their name and size.
+                        file_data['legacy_checksum'] = md5_for_string(filename+unicode(entry.stat.st_size))
+
+                    print "%s: %s" % (filename, dt)
+                    yield file_data
+        finally:
+            if pool:
+                closed.append(True)
+                window.release()
+                pool.terminate()
+            if dates is not None:
+                dates.close()
+            if dates_pool:
+                dates_pool.terminate()
+                dates_pool.join()
+            # Keep the files read so far when the sync fails.
+            file_data_cache.save()
+
+        print "Read %d bytes from %d of %d files (%d bytes in total)" % (
+            self.bytes_read, self.files_read, len(entries), sum([entry.stat.st_size for entry in entries]))
+
+    def _load_file_data_list(self):
+        entries, self.local_fingerprint = self._walk()
+        self.file_data_list = list(self._iter_file_data(self._filter_movie_thumbnails(entries)))
 
         # Make sure the list is sorted on datetime
         self.file_data_list.sort(lambda x, y: cmp(x['datetime'], y['datetime']))
-        
-        # If no files then we set the album time to the current time.
+
+        # Set album time to the time of the oldest photo in the album. If no
+        # files then we set the album time to the current time.
         if len(self.file_data_list) == 0:
             self.album_datetime = datetime.datetime.now()
+        else:
+            self.album_datetime = self.file_data_list[0]['datetime']
     
     def _save_picasa_sync_config(self):
-        with open(self.picasa_sync_config_filename, 'w') as f:
-            yaml.dump({"photos_by_id_map": self.synced_photos_by_id_map, "album_gphoto_id": self.synced_album_gphoto_id}, f)
+        # Write a snapshot of the sync state, replacing the journal.
+        picasa_sync_config = {"photos_by_id_map": self.synced_photos_by_id_map, "album_gphoto_id": self.synced_album_gphoto_id,
+                              "fingerprint": self.synced_fingerprint}
+        if self.store:
+            self.store.save_album(self.directory, picasa_sync_config)
+            return
+        write_picasa_sync_config(self.picasa_sync_config_filename, picasa_sync_config)
+        self.journal.remove()
+
+    def _journal_photo(self, gphoto_id):
+        filename, checksum = self.synced_photos_by_id_map[gphoto_id]
+        if self.store:
+            self.store.put_photo(self.directory, gphoto_id, filename, checksum)
+        else:
+            self.journal.append({'op': 'photo', 'id': gphoto_id, 'filename': filename, 'checksum': checksum})
+
+    def _journal_album(self):
+        if self.store:
+            self.store.put_album(self.directory, self.synced_album_gphoto_id, self.synced_fingerprint)
+        else:
+            self.journal.append({'op': 'album', 'id': self.synced_album_gphoto_id, 'fingerprint': self.synced_fingerprint})
         
     def _create_or_update_online_album(self, ps_client):
         if self.online_album:
@@ -248,51 +1430,58 @@ class Album(object):
                 self.online_album.timestamp.text = str(int(time.mktime(self.album_datetime.timetuple())*1000))
                 ps_client.Put(self.online_album, self.online_album.GetEditLink().href, converter=gdata.photos.AlbumEntryFromString)
                 print u"Existing album %s updated (title: %s, timestamp: %s)" % (old_online_album_title, self.title, self.album_datetime)
-                self._save_picasa_sync_config()
+                self._journal_album()
         else:
             print u"Creating new album %s" % self.title
             timestamp = str(int(time.mktime(self.album_datetime.timetuple())*1000))
             self.online_album = ps_client.InsertAlbum(title=self.title, summary=None, location=None, access='private', commenting_enabled='true', timestamp=timestamp)
             self.synced_album_gphoto_id = self.online_album.gphoto_id.text
-            self._save_picasa_sync_config()
+            self._journal_album()
                
-    def _create_or_update_online_files(self, ps_client):
+    def _mark_upload(self):
+        if self.first_upload_time is None:
+            self.first_upload_time = time.time()
+
+    def _create_or_update_online_files(self, ps_client, file_data_iter, local_filenames):
         print "Getting list of photos/videos for %s" % self.title
         existing_photos = ps_client.GetFeed('/data/feed/api/user/default/albumid/%s?kind=photo' % (self.synced_album_gphoto_id))
         id_existing_photos_map = dict([(photo.gphoto_id.text, photo) for photo in existing_photos.entry])
         updated_online_photos = set()
-        
-        # Build maps of files in directory
-        checksum_to_filename_map = {}
-        filename_to_checksum_map = {}
-        duplicate_checksums = set()
-        for file_data in self.file_data_list:
-            file_checksum = file_data['checksum']
-            if file_checksum in checksum_to_filename_map:
-                duplicate_checksums.add(file_checksum)
-
-            checksum_to_filename_map[file_checksum] = file_data['filename']
-            filename_to_checksum_map[file_data['filename']] = file_checksum
+        self.album_datetime = datetime.datetime.max
 
-        # Use the filename to checksum map to detect renamed files. We skip files
-        # with checksums that exist more than once in the directory, since we are
-        # then unable to distinguish the files.
-        rename_to_from_map = {}
+        # Photos synced before whose file no longer exists locally can be
+        # renamed to a new local file with the same checksum. If the checksum
+        # exists more than once in the directory, only the first file seen is
+        # treated as renamed.
+        rename_from_by_checksum = {}
         for gphoto_id, (filename, checksum) in self.synced_photos_by_id_map.iteritems():
-            if checksum in checksum_to_filename_map and not checksum in duplicate_checksums:
-                if filename != checksum_to_filename_map[checksum]:
-                    if self.synced_photos_by_filename_map[filename] in id_existing_photos_map:
-                        rename_to_from_map[checksum_to_filename_map[checksum]] = filename
+            if filename not in local_filenames and gphoto_id in id_existing_photos_map:
+                rename_from_by_checksum.setdefault(checksum, []).append(filename)
+        seen_checksums = set()
 
-        # Now update or create the online version
-        for file_data in self.file_data_list:
+        # Now update or create the online version of each file as its data
+        # becomes available.
+        for file_data in file_data_iter:
             filename = file_data['filename']
-            file_checksum = filename_to_checksum_map[filename]
-            
+            file_checksum = file_data['checksum']
+            file_checksums = file_data['checksums'].values()
+
+            # Set album time to the time of the oldest photo in the album
+            if file_data['datetime'] < self.album_datetime:
+                self.album_datetime = file_data['datetime']
+
             # Check if the file needs to be renamed.
-            if filename in rename_to_from_map:
+            rename_from_filename = None
+            is_online = filename in self.synced_photos_by_filename_map and self.synced_photos_by_filename_map[filename] in id_existing_photos_map
+            if not is_online:
+                for checksum in file_checksums:
+                    if checksum not in seen_checksums and rename_from_by_checksum.get(checksum):
+                        rename_from_filename = rename_from_by_checksum[checksum].pop()
+                        break
+            seen_checksums.update(file_checksums)
+
+            if rename_from_filename:
                 rename_to_title = get_photo_title(filename, self.directory)
-                rename_from_filename = rename_to_from_map[filename]
                 gphoto_id = self.synced_photos_by_filename_map[rename_from_filename]
                 photo = id_existing_photos_map[gphoto_id]
                 photo.title.text = rename_to_title
@@ -303,25 +1492,36 @@ class Album(object):
                 updated_online_photos.add(photo.gphoto_id.text)
                 self.synced_photos_by_id_map[photo.gphoto_id.text] = [filename, file_checksum]
                 self.synced_photos_by_filename_map[filename] = photo.gphoto_id.text
-                self._save_picasa_sync_config()
+                self._journal_photo(photo.gphoto_id.text)
                 
-            # If the local file does not exist online, we need to add it.
-            elif not filename in self.synced_photos_by_filename_map or not self.synced_photos_by_filename_map[filename] in id_existing_photos_map:
+            # If the local file does not exist online, we need to add it,
+            # unless it has been moved from another album.
+            elif not is_online:
                 photo_title = get_photo_title(filename, self.directory)
                 root, extension = os.path.splitext(filename)
                 extension = extension[1:].lower()
                 content_type = get_content_type_from_extension(extension)
-                if extension and content_type:
+                photo = None
+                if self.library:
+                    photo = self.library.move_photo(ps_client, file_checksums, self.synced_album_gphoto_id, filename, photo_title)
+                if photo:
+                    # Update local state
+                    updated_online_photos.add(photo.gphoto_id.text)
+                    self.synced_photos_by_id_map[photo.gphoto_id.text] = [filename, file_checksum]
+                    self.synced_photos_by_filename_map[filename] = photo.gphoto_id.text
+                    self._journal_photo(photo.gphoto_id.text)
+                elif extension and content_type:
                     file_size = os.path.getsize(filename)
                     if file_size < 100*(2**20):
                         print "Inserting new photo/video for %s" % filename
+                        self._mark_upload()
                         photo = ps_client.InsertPhotoSimple(self.online_album, photo_title, "", filename, content_type)
                         
                         # Update local state
                         updated_online_photos.add(photo.gphoto_id.text)
                         self.synced_photos_by_id_map[photo.gphoto_id.text] = [filename, file_checksum]
                         self.synced_photos_by_filename_map[filename] = photo.gphoto_id.text                    
-                        self._save_picasa_sync_config()            
+                        self._journal_photo(photo.gphoto_id.text)
                     else:
                         print "Skipping too large (%d MB) photo/video: %s" % ((int)(file_size/1024.0/1024.0), filename)
 
@@ -333,13 +1533,14 @@ class Album(object):
                 photo = id_existing_photos_map[gphoto_id]
         
                 # Update picture data if checksums differ.
-                if file_checksum != existing_checksum:
+                if not self._has_checksum(file_data, existing_checksum):
                     root, extension = os.path.splitext(filename)
                     extension = extension[1:].lower()
                     content_type = get_content_type_from_extension(extension)
                     if extension and content_type:
                         file_size = os.path.getsize(filename)
                         if file_size < 100*(2**20):
+                            self._mark_upload()
                             if 'image' in content_type:
                                 print "Updating photo blob for %s" % filename
                                 ps_client.UpdatePhotoBlob(photo, filename, content_type)                           
@@ -352,18 +1553,26 @@ class Album(object):
                             updated_online_photos.add(photo.gphoto_id.text)
                             self.synced_photos_by_id_map[photo.gphoto_id.text] = [filename, file_checksum]
                             self.synced_photos_by_filename_map[filename] = photo.gphoto_id.text                        
-                            self._save_picasa_sync_config()
+                            self._journal_photo(photo.gphoto_id.text)
                         else:
                             print "Not able to update too large (%d MB) photo/video: %s" % ((int)(file_size/1024.0/1024.0), filename)
                 else:
                     updated_online_photos.add(photo.gphoto_id.text)
+                    # Keep the checksum of the configured algorithm if the
+                    # file was hashed with it.
+                    self.synced_photos_by_id_map[gphoto_id] = [filename, file_checksum]
                     print "Photo/video %s already up to date" % filename
 
-        # Now delete any photos that no longer exists.
+        # Now delete any photos that no longer exists, once no other album
+        # can take them.
         for gphoto_id, photo in id_existing_photos_map.iteritems():
             if not gphoto_id in updated_online_photos:
-                print "Deleting photo/video %s" % photo.title.text
-                ps_client.Delete(photo)
+                if self.library:
+                    self.library.defer_deletion(photo)
+                    self.deferred_count += 1
+                else:
+                    print "Deleting photo/video %s" % photo.title.text
+                    ps_client.Delete(photo)
         
         # Update synced photos by ID to only reflect photos that have been updated during this run.
         filenames_check = set()
@@ -377,14 +1586,50 @@ class Album(object):
         self._save_picasa_sync_config()
         
     def update_online_album(self, ps_client):
-        if len(self.file_data_list) == 0:
-            self._load_file_data_list()
-        
-        if len(self.file_data_list) > 0:
+        # Forget the fingerprint until the sync has completed.
+        self.synced_fingerprint = None
+        self.deferred_count = 0
+        start_time = time.time()
+        self.first_upload_time = None
+
+        entries, self.local_fingerprint = self.walked or self._walk()
+        self.walked = None
+        entries = self._filter_movie_thumbnails(entries)
+        if len(entries) == 0:
+            return False
+
+        # A new album is created with the oldest modification time until the
+        # capture dates of all files are known.
+        if not self.online_album:
+            self.album_datetime = min([modification_date(entry.path, entry.stat) for entry in entries])
             self._create_or_update_online_album(ps_client)
-            if self.online_album:
-                self._create_or_update_online_files(ps_client)
-                return True
+
+        if self.online_album:
+            local_filenames = set([entry.path for entry in entries])
+            file_data_iter = self._iter_file_data(entries)
+            try:
+                self._create_or_update_online_files(ps_client, file_data_iter, local_filenames)
+            finally:
+                # Stops the worker threads if the sync failed, and keeps the
+                # photos already uploaded.
+                file_data_iter.close()
+                if self.store:
+                    self.store.commit()
+            # The uploads have changed the album, so update a fresh copy of it.
+            if unic(self.online_album.title.text) != self.title or self.online_album.timestamp.datetime() != self.album_datetime:
+                self._refresh_online_album(ps_client)
+            self._create_or_update_online_album(ps_client)
+            # The photos left for the library to delete are still online if
+            # the run stops before it does, so the album must be synced again.
+            if not self.deferred_count:
+                self._update_fingerprint(ps_client)
+
+            if self.first_upload_time is not None:
+                print "First upload started after %.1f seconds" % (self.first_upload_time - start_time)
+            peak_rss = peak_rss_bytes()
+            if peak_rss is not None:
+                print "Peak RSS %.1f MB" % (peak_rss / 1024.0 / 1024.0)
+            return True
 
         return False
         
@@ -397,9 +1642,31 @@ def generate_default_config_file(filename):
         "exclude_dirs": [".DS_Store"], # Directory names in this list will be exluded
         "delete_online_albums_not_local": False, # When this is true any existing online album that does not exist locally will be deleted
         "never_delete_online_albums": ["Camera Roll"], # Online album names in this list will never be deleted.
-        "update_local_albums_already_online": False}, f) # This decides whether albums that have been uploaded previously will be updated.
+        "update_local_albums_already_online": False, # This decides whether albums that have been uploaded previously will be updated.
+        "verify_checksums": False, # When this is true unchanged files are read and checksummed again instead of using the cached checksums.
+        "worker_threads": None, # Number of threads reading and checksumming files (None: twice the number of CPUs, at most 16).
+        "max_inflight_blocks": None, # Maximum number of 1 MB blocks held in memory by the checksumming threads (None: twice the number of threads).
+        "exif_backend": "thread", # Where dates are parsed: "thread" in the checksumming threads or "process" in a pool of worker_threads processes.
+        "hash_algorithm": "md5", # Checksum algorithm: "md5", "blake2b" (needs Python 3.6 or pyblake2), or "md5-tree"/"blake2b-tree" to hash large files on several threads.
+        "detect_moves": True, # When this is true photos moved to another album directory are moved online instead of uploaded again.
+        "journal_group_size": 32, # Number of changes to the sync state written to disk together (at most a second apart); a crash loses at most this many.
+        "state_database": None}, f) # SQLite database holding the sync state of all albums instead of a .picasa-sync file in each album directory (None: use the files).
+
+def list_album_directories(photo_dir, exclude_matcher):
+    local_albums = map(fs_unic, [local_album_title for local_album_title in os.listdir(photo_dir)])
+    # LOG.debug('local_albums: %r', local_albums)
+    local_albums.sort(key=lambda s: s.lower(), reverse=True)
+    album_directories = [os.path.join(photo_dir, local_album_title) for local_album_title in local_albums]
+    return [directory for directory in album_directories
+            if os.path.isdir(directory) and not os.path.islink(directory)
+            and not exclude_matcher(os.path.basename(directory))]
     
 def main(argv):
+    # --import-state copies the .picasa-sync files of all albums into the
+    # state database, --export-state writes them back from it.
+    command = None
+    if argv and argv[0] in ('--import-state', '--export-state'):
+        command = argv.pop(0)
     if len(argv) == 1:
         config_filename = argv[0]
     else:
@@ -418,6 +1685,29 @@ def main(argv):
         delete_online_albums_not_local = config['delete_online_albums_not_local']
         never_delete_online_albums = config['never_delete_online_albums']
         update_local_albums_already_online = config['update_local_albums_already_online']
+        verify_checksums = config.get('verify_checksums', False)
+        worker_threads = config.get('worker_threads')
+        max_inflight_blocks = config.get('max_inflight_blocks')
+        exif_backend = config.get('exif_backend', 'thread')
+        hash_algorithm = config.get('hash_algorithm', 'md5')
+        detect_moves = config.get('detect_moves', True)
+        journal_group_size = config.get('journal_group_size', 32)
+        state_database = config.get('state_database')
+
+    exclude_matcher = PatternMatcher(exclude_dirs)
+    store = None
+    if state_database:
+        store = SyncStateStore(os.path.expanduser(state_database), journal_group_size)
+    if command:
+        if not store:
+            print "No state_database in %s" % config_filename
+        elif command == '--import-state':
+            store.import_directories(list_album_directories(photo_dir, exclude_matcher), replace=True)
+        else:
+            store.export_directories(list_album_directories(photo_dir, exclude_matcher))
+        if store:
+            store.close()
+        return
     
     gdata.photos.service.SUPPORTED_UPLOAD_TYPES = ('bmp', 'jpeg', 'jpg', 'gif', 'png', 'mov', 'mpg', 'mpeg')
     
@@ -434,6 +1724,11 @@ def main(argv):
         else:
             print 'Failed to request access'
             return
+
+    # Forked before any thread is started, and shared by all albums.
+    exif_pool = None
+    if exif_backend == 'process':
+        exif_pool = multiprocessing.Pool(worker_threads or default_worker_threads())
                 
     try:
         print "Getting online albums"
@@ -441,22 +1736,25 @@ def main(argv):
         id_to_online_album_map = dict([(album.gphoto_id.text, album) for album in online_albums.entry])
         
         print "Getting local albums"
-        local_albums = map(fs_unic, [local_album_title for local_album_title in os.listdir(photo_dir)])
-        # LOG.debug('local_albums: %r', local_albums)
-        local_albums.sort(key=lambda s: s.lower(), reverse=True)
         expr = re.compile("\[\d{4,4}-\d{2,2}-\d{2,2}\] (.+)")
-        
-        for local_album_title in local_albums:
-            directory = os.path.join(photo_dir, local_album_title)
-            if not os.path.isdir(directory) or os.path.islink(directory) or does_match_pattern(local_album_title, exclude_dirs):
-                continue
-            
+        include_matcher = PatternMatcher(include_files)
+        album_directories = list_album_directories(photo_dir, exclude_matcher)
+        # Albums synced before the database was configured keep their state.
+        if store:
+            store.import_directories(album_directories)
+        library = Library(album_directories, store) if detect_moves else None
+
+        for directory in album_directories:
+            local_album_title = os.path.basename(directory)
+
             # Check if the album is prefixed with date.
             m = expr.match(local_album_title)
             if m != None:
                 local_album_title = m.group(1)              
                     
-            album = Album(directory, local_album_title, include_files, exclude_dirs)
+            album = Album(directory, local_album_title, include_matcher, exclude_matcher, verify_checksums,
+                          worker_threads, max_inflight_blocks, exif_backend, hash_algorithm, library,
+                          journal_group_size, store, exif_pool)
             
             # Set the online album if it exists.
             if album.synced_album_gphoto_id in id_to_online_album_map:
@@ -469,7 +1767,10 @@ def main(argv):
                                      
                     # Update the online album from the local directory.
                     if not album.online_album or update_local_albums_already_online:
-                        album.update_online_album(gd_client)
+                        if album.is_unchanged():
+                            print "Album %s has not changed since last sync - skipping" % album.title
+                        else:
+                            album.update_online_album(gd_client)
 
                     # Remove the album from the existing online albums map. Then we
                     # can delete all remaining albums when sync is completed.
@@ -492,6 +1793,26 @@ def main(argv):
                     # Album updated - break from inner loop
                     break 
                                        
+        # Delete the photos that were not moved to other albums.
+        retry_count = 0
+        while library:
+            try:
+                retry_count += 1
+                library.delete_deferred(gd_client)
+            except Exception, e:
+                if "Token invalid" in str(e):
+                    raise
+
+                traceback.print_exc()
+                if retry_count <= 10:
+                    print "Exception occurred (%s) - sleeping for 2 minuttes before retrying." % str(e)
+                    time.sleep(120) # Sleep for 2 mins.
+                else:
+                    print "Maximum retry count exceeded - aborting."
+                    return
+            else:
+                break
+
         # Delete albums online that no longer exist locally, if enabled.
         while delete_online_albums_not_local:
             try:                                       
@@ -534,6 +1855,13 @@ def main(argv):
             os.remove(token_filename)
         else:
             raise
+    finally:
+        # Commits the changes of an album that failed.
+        if store:
+            store.close()
+        if exif_pool:
+            exif_pool.terminate()
+            exif_pool.join()
             
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)